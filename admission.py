@@ -0,0 +1,89 @@
+import os
+import metrics
+from queue_view import format_duration
+
+
+# Every limit is off when set to 0
+max_voice_sessions = int(os.getenv("max_voice_sessions", "0"))
+# Load average per cpu above which no new voice sessions are started
+max_load_per_cpu = float(os.getenv("max_load_per_cpu", "0"))
+max_pending_downloads = int(os.getenv("max_pending_downloads", "0"))
+max_queue_length = int(os.getenv("max_queue_length", "0"))
+max_track_duration = int(os.getenv("max_track_duration", "0"))
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request would take the bot over one of its limits, the message is the reply for the user"""
+
+
+class AdmissionControl:
+    """Limits checked before the bot takes on more work, so a busy host turns new requests away straight away
+    instead of every guild that is already playing starting to stutter. Each check raises AdmissionRejected"""
+
+    def __init__(self, sessions, db, prefetcher, voice_sessions=max_voice_sessions, load_per_cpu=max_load_per_cpu,
+                 pending_downloads=max_pending_downloads, queue_length=max_queue_length,
+                 track_duration=max_track_duration):
+        self.sessions = sessions
+        self.db = db
+        self.prefetcher = prefetcher
+        self.voice_sessions = voice_sessions
+        self.load_per_cpu = load_per_cpu
+        self.pending_downloads = pending_downloads
+        self.queue_length = queue_length
+        self.track_duration = track_duration
+        # guild id -> joins in progress, their sessions aren't open yet but already count against voice_sessions
+        self.__joining = {}
+
+    def admit_session(self, guild_id):
+        """Checked before joining a voice channel in a guild the bot isn't playing in yet"""
+
+        if guild_id in self.sessions or guild_id in self.__joining:
+            return
+        if self.voice_sessions and len(self.sessions) + len(self.__joining) >= self.voice_sessions:
+            self.__reject("I'm playing in too many servers right now, try again later!")
+        if self.load_per_cpu and os.getloadavg()[0] / os.cpu_count() >= self.load_per_cpu:
+            self.__reject("I'm too busy to join right now, try again in a few minutes!")
+
+    def reserve_session(self, guild_id):
+        """Checks admit_session and holds the guild's session slot until release_session, so joins waiting to connect
+        at the same time can't all be admitted"""
+
+        self.admit_session(guild_id)
+        self.__joining[guild_id] = self.__joining.get(guild_id, 0) + 1
+
+    def release_session(self, guild_id):
+        """Called once the joining session is open or the join failed"""
+
+        count = self.__joining.pop(guild_id) - 1
+        if count > 0:
+            self.__joining[guild_id] = count
+
+    def queue_space(self, guild_id):
+        """How many more songs the guild can queue, None without a limit"""
+
+        if not self.queue_length:
+            return None
+        # None when the guild has no queue yet
+        queued = self.db.queue_size(guild_id) or 0
+        return max(self.queue_length - queued, 0)
+
+    def admit_queue(self, guild_id, count=1):
+        space = self.queue_space(guild_id)
+        if space is not None and space < count:
+            self.__reject(f"The queue is full, at most {self.queue_length} songs can be queued!")
+
+    def admit_track(self, track):
+        if self.track_duration and track.duration is not None and track.duration > self.track_duration:
+            self.__reject(f"***{track.title}*** is too long, songs can be at most "
+                          f"{format_duration(self.track_duration)} long!")
+
+    def admit_download(self, track):
+        """Checked before queueing a track that still has to be downloaded"""
+
+        if (self.pending_downloads and not self.prefetcher.is_ready(track)
+                and self.prefetcher.downloads >= self.pending_downloads):
+            self.__reject("Too many songs are being downloaded right now, try again in a moment!")
+
+    def __reject(self, message):
+        metrics.admission_rejections.inc()
+        raise AdmissionRejected(message)
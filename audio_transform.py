@@ -0,0 +1,134 @@
+import os
+import discord
+import numpy
+
+
+volume_ramp_seconds = float(os.getenv("volume_ramp_seconds", "0.25"))
+fade_seconds = float(os.getenv("fade_seconds", "0.5"))
+
+# Same cap as discord.PCMVolumeTransformer, anything louder is mostly clipping
+max_gain = 2.0
+frame_seconds = discord.opus.Encoder.FRAME_LENGTH / 1000
+channels = discord.opus.Encoder.CHANNELS
+
+
+class FrameScaler:
+    """Scales frames of 16 bit stereo PCM. The intermediate arrays are allocated once and reused for every frame,
+    the only copy made per frame is the bytes handed back"""
+
+    def __init__(self, frame_size=discord.opus.Encoder.FRAME_SIZE):
+        samples = frame_size // 2
+        # Position of every sample of a frame between its start (0) and end (1), the channels of a sample sharing it
+        self.positions = numpy.repeat(
+            numpy.arange(samples // channels, dtype=numpy.float32) / (samples // channels), channels)
+        self.gains = numpy.empty(samples, dtype=numpy.float32)
+        self.scaled = numpy.empty(samples, dtype=numpy.float32)
+        self.output = numpy.empty(samples, dtype=numpy.int16)
+
+    def scale(self, frame, start_gain, end_gain):
+        """Ramps the gain linearly from start_gain to end_gain over the frame"""
+
+        if start_gain == end_gain == 1:
+            return frame
+        samples = numpy.frombuffer(frame, dtype=numpy.int16)
+        if len(samples) != len(self.output):
+            # The last frame of a track can be short
+            return FrameScaler(len(frame)).scale(frame, start_gain, end_gain)
+
+        if start_gain == end_gain:
+            numpy.multiply(samples, numpy.float32(start_gain), out=self.scaled)
+        else:
+            numpy.multiply(self.positions, numpy.float32(end_gain - start_gain), out=self.gains)
+            self.gains += numpy.float32(start_gain)
+            numpy.multiply(samples, self.gains, out=self.scaled)
+        if max(start_gain, end_gain) > 1:
+            # The ufuncs directly, numpy.clip's argument handling costs more than the clipping
+            numpy.minimum(self.scaled, 32767, out=self.scaled)
+            numpy.maximum(self.scaled, -32768, out=self.scaled)
+        numpy.copyto(self.output, self.scaled, casting="unsafe")
+        return self.output.tobytes()
+
+
+def mix(first, second):
+    """Adds two frames of 16 bit PCM together, the shorter one padded with silence"""
+
+    if len(first) < len(second):
+        first, second = second, first
+    mixed = numpy.frombuffer(first, dtype=numpy.int16).astype(numpy.int32)
+    mixed[:len(second) // 2] += numpy.frombuffer(second, dtype=numpy.int16)
+    numpy.minimum(mixed, 32767, out=mixed)
+    numpy.maximum(mixed, -32768, out=mixed)
+    return mixed.astype(numpy.int16).tobytes()
+
+
+class PCMTransformer(discord.AudioSource):
+    """Volume control for PCM sources, a replacement for discord.PCMVolumeTransformer.
+
+    Volume changes are ramped over ramp_seconds instead of jumping from one frame to the next, and the source can
+    fade in and fade out. A source that has faded out ends, like it would at the end of its track.
+
+    applied is the volume the original source already plays at, e.g. because ffmpeg applies it while decoding.
+    Frames are only scaled by the difference, so at that volume they are passed through untouched.
+    """
+
+    def __init__(self, original, volume=1.0, ramp_seconds=volume_ramp_seconds, applied=1.0):
+        if not isinstance(original, discord.AudioSource):
+            raise TypeError(f"expected AudioSource not {original.__class__.__name__}.")
+        if original.is_opus():
+            raise discord.ClientException("AudioSource must not be Opus encoded.")
+
+        self.original = original
+        self.ramp_seconds = ramp_seconds
+        self.applied = applied
+        self.faded_out = False
+
+        self.__volume = max(volume, 0.0)
+        # Gain applied at the end of the last frame, it moves towards the target by step every frame
+        self.__gain = self.__volume
+        self.__target = self.__volume
+        self.__step = 0.0
+        self.__fading_out = False
+        self.__scaler = FrameScaler()
+
+    @property
+    def volume(self):
+        return self.__volume
+
+    @volume.setter
+    def volume(self, value):
+        self.__volume = max(value, 0.0)
+        if not self.__fading_out:
+            self.__ramp_to(self.__volume, self.ramp_seconds)
+
+    def fade_in(self, seconds=fade_seconds):
+        self.__gain = 0.0
+        self.__ramp_to(self.__volume, seconds)
+
+    def fade_out(self, seconds=fade_seconds):
+        self.__fading_out = True
+        self.__ramp_to(0.0, seconds)
+
+    def __ramp_to(self, target, seconds):
+        frames = max(1, round(seconds / frame_seconds))
+        self.__target = target
+        self.__step = abs(target - self.__gain) / frames
+
+    def read(self):
+        if self.faded_out:
+            return b""
+        frame = self.original.read()
+        if not frame:
+            return frame
+
+        start = self.__gain
+        if start < self.__target:
+            self.__gain = min(start + self.__step, self.__target)
+        elif start > self.__target:
+            self.__gain = max(start - self.__step, self.__target)
+        if self.__fading_out and self.__gain == 0:
+            self.faded_out = True
+        return self.__scaler.scale(frame, min(start, max_gain) / self.applied,
+                                   min(self.__gain, max_gain) / self.applied)
+
+    def cleanup(self):
+        self.original.cleanup()
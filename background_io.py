@@ -0,0 +1,71 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class BackgroundIO:
+    """A single thread doing the bot's blocking file operations off the event loop.
+
+    Jobs run one at a time in the order they were submitted, so a file written and later deleted is never deleted
+    first. Deletions are batched: files deleted while the thread is busy are all removed by one job.
+    """
+
+    def __init__(self):
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="background-io")
+        self.__lock = threading.Lock()
+        self.__pending_deletes = []
+
+    @property
+    def pending_deletes(self):
+        return len(self.__pending_deletes)
+
+    def submit(self, function, *args):
+        """Runs function(*args) on the thread. Nothing waits for it, failures are logged"""
+
+        future = self.__executor.submit(function, *args)
+        future.add_done_callback(self.__log_failure)
+
+    async def run(self, function, *args):
+        """Runs function(*args) on the thread and waits for its result"""
+
+        return await asyncio.wrap_future(self.__executor.submit(function, *args))
+
+    def delete(self, *paths):
+        """Deletes the files in the background. Files that are already gone are ignored"""
+
+        with self.__lock:
+            flush_scheduled = bool(self.__pending_deletes)
+            self.__pending_deletes.extend(paths)
+        if not flush_scheduled:
+            self.submit(self.__flush_deletes)
+
+    def cancel_delete(self, *paths):
+        """Keeps files from being deleted if their deletion hasn't started yet, e.g. because they were downloaded
+        again"""
+
+        with self.__lock:
+            self.__pending_deletes = [path for path in self.__pending_deletes if path not in paths]
+
+    def shutdown(self, wait=True):
+        self.__executor.shutdown(wait=wait)
+
+    def __flush_deletes(self):
+        with self.__lock:
+            paths, self.__pending_deletes = self.__pending_deletes, []
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.getLogger().log(logging.ERROR, f"Error deleting file. Message: {e}")
+        if paths:
+            logging.getLogger().log(logging.DEBUG, f"Deleted {len(paths)} files")
+
+    @staticmethod
+    def __log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.getLogger().log(logging.ERROR, f"Error in a background file operation. "
+                                                   f"Message: {future.exception()}")
@@ -0,0 +1,44 @@
+"""Offline benchmarks, run from the repository root with: python -m benchmarks [--quick] [--output results.json]
+
+Nothing here talks to Discord or YouTube. The db benchmarks time InMemoryDb directly, the transform benchmarks time
+the PCM volume transforms per frame and the cog benchmarks drive the Music cog with fake contexts and voice clients
+and a stubbed yt-dlp."""
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Runs the offline benchmarks")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes, for a quick check")
+    parser.add_argument("--only", choices=("db", "cog", "transform"), help="run a single benchmark")
+    parser.add_argument("--output", default="benchmark_results.json", help="file the json results are written to")
+    args = parser.parse_args()
+
+    results = {
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "quick": args.quick,
+    }
+    # The cog benchmark changes the bot's settings when imported, so each benchmark is only imported when it runs
+    if args.only in (None, "db"):
+        from benchmarks import bench_db
+        results["db"] = bench_db.run(args.quick)
+    if args.only in (None, "transform"):
+        from benchmarks import bench_transform
+        results["transform"] = bench_transform.run(args.quick)
+    if args.only in (None, "cog"):
+        from benchmarks import bench_cog
+        results["cog"] = bench_cog.run(args.quick)
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Wrote the benchmark results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
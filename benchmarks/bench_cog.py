@@ -0,0 +1,246 @@
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+# The bot reads its settings when its modules are imported, so the benchmark points them at a scratch directory
+# and pins the settings that change the measured path before importing anything from the bot
+scratch_directory = tempfile.mkdtemp(prefix="musicbot-bench-")
+os.environ["downloads_subdirectory"] = scratch_directory
+os.environ["metadata_cache_path"] = os.path.join(scratch_directory, "metadata.sqlite3")
+os.environ["playback_mode"] = "download"
+os.environ["opus_cache"] = "0"
+os.environ["extraction_backend"] = "thread"
+# Every guild enqueues at once, the default limit would reject most of them and mix their fast failures into the
+# enqueue latencies
+os.environ["extraction_max_pending"] = "100000"
+
+import discord  # noqa: E402
+from discord.ext import commands  # noqa: E402
+import ytdl  # noqa: E402
+import discord_bot  # noqa: E402
+from cache import AudioCache  # noqa: E402
+from data.InMemoryDb import InMemoryDb  # noqa: E402
+from metadata_cache import MetadataCache  # noqa: E402
+
+
+# Simulated yt-dlp latencies in seconds, roughly what a warm extractor sees for a single video
+extract_delay = 0.02
+download_delay = 0.05
+download_bytes = 64 * 1024
+
+
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL. Extraction sleeps instead of going to the network and downloads write a
+    small file, so everything after yt-dlp runs for real"""
+
+    def extract_info(self, url, download=False):
+        video_id = url.rsplit("=", 1)[-1]
+        data = {
+            "id": video_id,
+            "title": f"Benchmark song {video_id}",
+            "original_url": url,
+            "webpage_url": url,
+            "duration": 180,
+            "extractor_key": "Youtube",
+            "url": f"https://media.invalid/{video_id}",
+        }
+        time.sleep(extract_delay)
+        if download:
+            time.sleep(download_delay)
+            with open(self.prepare_filename(data), "wb") as f:
+                f.write(b"\0" * download_bytes)
+        return data
+
+    def prepare_filename(self, data):
+        return os.path.join(ytdl.download_path, f"{data['extractor_key']}-{data['id']}.mp3")
+
+
+class FakeSource(discord.AudioSource):
+    """Replaces the ffmpeg backed sources, ffmpeg startup isn't part of what this benchmark measures"""
+
+    def __init__(self, track, *, position=0, volume=ytdl.default_volume):
+        self.track = track
+        self.volume = volume
+
+    def read(self):
+        return b"\0" * 3840
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class FakeVoiceClient:
+    def __init__(self, channel_id):
+        self.channel = FakeChannel(channel_id)
+        self.source = None
+        self.started_at = None
+
+    def play(self, source, *, after=None):
+        self.source = source
+        self.started_at = time.perf_counter()
+
+    def is_playing(self):
+        return self.source is not None
+
+    def is_paused(self):
+        return False
+
+    def is_connected(self):
+        return True
+
+    def stop(self):
+        self.source = None
+
+
+class FakeMessage:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.channel = ctx.channel
+
+    async def edit(self, **kwargs):
+        self.ctx.edited += 1
+        return self
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeContext:
+    def __init__(self, guild_id):
+        self.guild = FakeGuild(guild_id)
+        self.channel = FakeChannel(guild_id)
+        self.voice_client = FakeVoiceClient(channel_id=guild_id)
+        self.sent = 0
+        self.edited = 0
+
+    async def send(self, *args, **kwargs):
+        self.sent += 1
+        return FakeMessage(self)
+
+    def typing(self):
+        return FakeTyping()
+
+
+def url_for(guild_id, index):
+    return f"https://www.youtube.com/watch?v=g{guild_id:05d}s{index:04d}"
+
+
+def summarise(timings):
+    timings = sorted(timings)
+    if not timings:
+        return {"count": 0}
+    return {
+        "count": len(timings),
+        "mean_ms": sum(timings) / len(timings) * 1e3,
+        "p50_ms": timings[len(timings) // 2] * 1e3,
+        "p95_ms": timings[min(len(timings) - 1, int(len(timings) * 0.95))] * 1e3,
+        "max_ms": timings[-1] * 1e3,
+    }
+
+
+async def timed(coroutine):
+    start = time.perf_counter()
+    await coroutine
+    return time.perf_counter() - start
+
+
+async def bench_guilds(cog, guilds, songs_per_guild):
+    contexts = [FakeContext(guild_id) for guild_id in range(guilds)]
+    for ctx in contexts:
+        await cog.ensure_voice(ctx)
+
+    # Time to first audio, every guild starts playing at the same time so they compete for the workers
+    starts = [time.perf_counter() for _ in contexts]
+    await asyncio.gather(*(cog.play(ctx, url=url_for(ctx.guild.id, 0)) for ctx in contexts))
+    first_audio = [ctx.voice_client.started_at - start for ctx, start in zip(contexts, starts)
+                   if ctx.voice_client.started_at is not None]
+
+    # Enqueue latency while every guild is playing
+    enqueues = await asyncio.gather(*(timed(cog.play(ctx, url=url_for(ctx.guild.id, i)))
+                                      for i in range(1, songs_per_guild + 1) for ctx in contexts))
+    # None for guilds whose songs were all rejected
+    queued = sum(cog.db.queue_size(ctx.guild.id) or 0 for ctx in contexts)
+    # Lets the coalesced status message edits go out before counting the messages
+    await asyncio.sleep(cog.status.interval)
+    sent = sum(ctx.sent for ctx in contexts)
+    edited = sum(ctx.edited for ctx in contexts)
+
+    for ctx in contexts:
+        cog.remove_guild_items(ctx.guild.id)
+    return {
+        "guilds": guilds,
+        "songs_per_guild": songs_per_guild,
+        "time_to_first_audio": summarise(first_audio),
+        "enqueue": summarise(enqueues),
+        # Enqueues turned away by the extraction scheduler's admission limit
+        "rejected": guilds * songs_per_guild - queued,
+        "messages_sent": sent,
+        "messages_edited": edited,
+    }
+
+
+async def bench_memory(cog, songs):
+    """Bytes held per track queued through the play command, with the tracks already in the metadata cache"""
+
+    ctx = FakeContext(guild_id=10_000_000)
+    await cog.ensure_voice(ctx)
+    await cog.play(ctx, url=url_for(ctx.guild.id, 0))
+    for i in range(1, songs + 1):
+        await cog.play(ctx, url=url_for(ctx.guild.id, i))
+    cog.db.delete_queue(ctx.guild.id)
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    for i in range(1, songs + 1):
+        await cog.play(ctx, url=url_for(ctx.guild.id, i))
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    cog.remove_guild_items(ctx.guild.id)
+    return {"tracks": songs, "bytes_per_track": allocated / songs}
+
+
+async def run_async(quick):
+    bot = commands.Bot(command_prefix="^", intents=discord.Intents.default())
+    async with bot:
+        bot.logger = logging.getLogger()
+        db = InMemoryDb()
+        cache = AudioCache(ytdl.download_path, ytdl.cache_max_bytes, is_pinned=db.is_track_referenced)
+        cache.rebuild_index()
+        metadata_cache = MetadataCache(ytdl.metadata_cache_path, ytdl.metadata_cache_ttl,
+                                       ytdl.metadata_cache_max_entries)
+        cog = discord_bot.Music(bot, db, cache, metadata_cache)
+        await bot.add_cog(cog)
+
+        runs = [(1, 20), (10, 5)] if quick else [(1, 50), (10, 20), (50, 5)]
+        results = {"guilds": [await bench_guilds(cog, guilds, songs) for guilds, songs in runs],
+                   "memory": await bench_memory(cog, 100 if quick else 1_000)}
+        await bot.remove_cog("Music")
+        return results
+
+
+def run(quick=False):
+    fake_ytdl = FakeYoutubeDL()
+    ytdl.get_ytdl = lambda: fake_ytdl
+    discord_bot.create_source = FakeSource
+    try:
+        return asyncio.run(run_async(quick))
+    finally:
+        shutil.rmtree(scratch_directory, ignore_errors=True)
@@ -0,0 +1,76 @@
+import random
+import time
+import tracemalloc
+from data.InMemoryDb import InMemoryDb
+from data.Track import Track
+
+
+# (queued tracks, guilds)
+sizes = [(1_000, 1), (10_000, 100), (100_000, 5_000)]
+quick_sizes = [(1_000, 1), (10_000, 100)]
+
+
+def make_track(i):
+    return Track(key=f"Youtube-{i:011d}", id=f"{i:011d}", title=f"Song number {i}",
+                 original_url=f"https://www.youtube.com/watch?v={i:011d}", duration=180.0)
+
+
+def fill_db(tracks, guilds):
+    db = InMemoryDb()
+    for i in range(tracks):
+        db.add_to_queue(i % guilds, make_track(i))
+    return db
+
+
+def time_operation(operation, repeat):
+    """Runs operation repeat times and returns the mean and worst time per call in microseconds"""
+
+    timings = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        operation(i)
+        timings.append(time.perf_counter() - start)
+    return {"mean_us": sum(timings) / len(timings) * 1e6, "max_us": max(timings) * 1e6, "calls": repeat}
+
+
+def bench_size(tracks, guilds, repeat):
+    db = fill_db(tracks, guilds)
+    queue_length = tracks // guilds
+    rng = random.Random(0)
+
+    def random_indexes():
+        return rng.randint(1, queue_length), rng.randint(1, queue_length)
+
+    results = {
+        "enqueue": time_operation(lambda i: db.add_to_queue(i % guilds, make_track(tracks + i)), repeat),
+        "swap": time_operation(lambda i: db.queue_swap(i % guilds, *random_indexes()), repeat),
+        "move": time_operation(lambda i: db.queue_move(i % guilds, *random_indexes()), repeat),
+        "player_in_any_queue": time_operation(lambda i: db.player_in_any_queue(make_track(tracks * 2 + i)),
+                                              min(repeat, 20)),
+        "is_track_referenced": time_operation(lambda i: db.is_track_referenced(make_track(i).key), repeat),
+        "pop": time_operation(lambda i: db.advance_queue(i % guilds), repeat),
+    }
+    # Jumps shrink the queues, so they run last and only jump a short way
+    results["jump"] = time_operation(lambda i: db.queue_jump(i % guilds, 2), repeat)
+    return results
+
+
+def bench_memory(tracks):
+    """Bytes allocated per queued track, including the db's reference count entry"""
+
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    db = fill_db(tracks, 1)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, "filename"))
+    del db
+    return {"tracks": tracks, "bytes_per_track": allocated / tracks}
+
+
+def run(quick=False):
+    results = []
+    for tracks, guilds in (quick_sizes if quick else sizes):
+        results.append({"tracks": tracks, "guilds": guilds, "operations": bench_size(tracks, guilds, 1_000)})
+    return {"sizes": results, "memory": bench_memory(10_000)}
@@ -0,0 +1,61 @@
+import os
+import time
+import discord
+import audio_transform
+from audio_transform import PCMTransformer
+
+
+frame_bytes = discord.opus.Encoder.FRAME_SIZE
+
+
+class LoopingSource(discord.AudioSource):
+    """Hands out the same frame of random PCM forever, so only the transform is measured"""
+
+    def __init__(self):
+        self.frame = os.urandom(frame_bytes)
+
+    def read(self):
+        return self.frame
+
+
+def cpu_per_frame(source, frames, prepare=None):
+    """CPU time per read in microseconds. prepare(i) runs before every read, outside the timing"""
+
+    total = 0.0
+    for i in range(frames):
+        if prepare is not None:
+            prepare(i)
+        start = time.process_time()
+        source.read()
+        total += time.process_time() - start
+    return total / frames * 1e6
+
+
+def bench_transformers(frames):
+    results = {"discord_volume_transformer": cpu_per_frame(discord.PCMVolumeTransformer(LoopingSource(), 0.5), frames),
+               # At the volume ffmpeg already applied, the usual case
+               "unchanged_volume": cpu_per_frame(PCMTransformer(LoopingSource(), 0.5, applied=0.5), frames),
+               "changed_volume": cpu_per_frame(PCMTransformer(LoopingSource(), 0.75, applied=0.5), frames)}
+
+    ramping = PCMTransformer(LoopingSource(), 0.5, ramp_seconds=1, applied=0.5)
+    # Changes the volume every 25 frames, so most frames are part of a ramp
+
+    def change_volume(i):
+        if i % 25 == 0:
+            ramping.volume = 0.25 if ramping.volume == 0.5 else 0.5
+
+    results["ramping_volume"] = cpu_per_frame(ramping, frames, change_volume)
+
+    first, second = LoopingSource(), LoopingSource()
+
+    class Crossfade(discord.AudioSource):
+        def read(self):
+            return audio_transform.mix(first.read(), second.read())
+
+    results["mix"] = cpu_per_frame(Crossfade(), frames)
+    return results
+
+
+def run(quick=False):
+    frames = 2_000 if quick else 20_000
+    return {"frames": frames, "cpu_us_per_frame": bench_transformers(frames)}
@@ -0,0 +1,62 @@
+import asyncio
+import os
+
+
+# Entries of one ^play_many looked up at the same time
+bulk_resolve_concurrency = int(os.getenv("bulk_resolve_concurrency", "4"))
+# Attached lists bigger than this aren't read
+max_attachment_bytes = 64 * 1024
+
+
+def parse_entries(text):
+    """Splits the text of a ^play_many into songs: one url or search query per line, lines starting with # are
+    skipped. A line of several urls is split into one song per url, a line of words is a single search query"""
+
+    entries = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        words = [word.strip("<>") for word in line.split()]
+        if len(words) > 1 and all(word.startswith(("http://", "https://")) for word in words):
+            entries.extend(words)
+        else:
+            entries.append(line.strip("<>"))
+    return entries
+
+
+async def attachment_text(attachment):
+    """Text of an attached list of songs, None if the attachment isn't a text file or is too big"""
+
+    content_type = attachment.content_type or ""
+    if not content_type.startswith("text/") and not attachment.filename.endswith(".txt"):
+        return None
+    if attachment.size > max_attachment_bytes:
+        return None
+    return (await attachment.read()).decode("utf-8", errors="replace")
+
+
+async def resolve_in_order(entries, resolve, limit=bulk_resolve_concurrency):
+    """Runs resolve(entry) for every entry, at most limit at a time, and yields (entry, result, error) in the order
+    of the entries. Each one is yielded as soon as it and every entry before it are done, so the caller can queue
+    the first songs while the rest are still being looked up"""
+
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(entry):
+        async with semaphore:
+            return await resolve(entry)
+
+    tasks = [asyncio.ensure_future(run(entry)) for entry in entries]
+    try:
+        for entry, task in zip(entries, tasks):
+            try:
+                yield entry, await task, None
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                yield entry, None, e
+    finally:
+        # The caller stopped early or the command was cancelled, nothing left is going to be queued
+        for task in tasks:
+            task.cancel()
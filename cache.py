@@ -0,0 +1,234 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheEntry:
+    __slots__ = ("key", "filepath", "size", "hits", "last_used", "loudness")
+
+    def __init__(self, key, filepath, size, hits=0, last_used=None, loudness=None):
+        self.key = key
+        self.filepath = filepath
+        self.size = size
+        self.hits = hits
+        self.last_used = last_used if last_used is not None else time.time()
+        self.loudness = loudness
+
+
+class AudioCache:
+    """Size bounded on-disk cache of downloaded audio files.
+
+    Entries are keyed by "<extractor>-<video id>". Each audio file has a json sidecar holding the metadata needed to
+    play it again without going through yt-dlp. Entries that are pinned (queued or now playing) are never evicted.
+    With a BackgroundIO, files are deleted and sidecars written on its thread instead of the caller's.
+    """
+
+    audio_extensions = (".mp3", ".opus")
+    metadata_extension = ".json"
+
+    def __init__(self, directory, max_bytes, policy="lru", is_pinned=None, io=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.is_pinned = is_pinned or (lambda key: False)
+        self.io = io
+
+        self.__entries = OrderedDict()
+        # key -> metadata of sidecars queued on the io thread but not written yet
+        self.__unwritten = {}
+        self.__unwritten_lock = threading.Lock()
+        self.__size = 0
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def size(self):
+        return self.__size
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def __contains__(self, key):
+        return key in self.__entries
+
+    def cached_filepath(self, key):
+        entry = self.__entries.get(key)
+        return entry.filepath if entry is not None else None
+
+    def loudness(self, key):
+        entry = self.__entries.get(key)
+        return entry.loudness if entry is not None else None
+
+    def metadata_path(self, key):
+        return os.path.join(self.directory, f"{key}{self.metadata_extension}")
+
+    def rebuild_index(self):
+        """Indexes the audio files that are already in the cache directory, oldest first"""
+
+        os.makedirs(self.directory, exist_ok=True)
+        self.__entries.clear()
+        self.__size = 0
+
+        found = []
+        with os.scandir(self.directory) as dir_entries:
+            for dir_entry in dir_entries:
+                key, extension = os.path.splitext(dir_entry.name)
+                if extension not in self.audio_extensions or not dir_entry.is_file():
+                    continue
+                stat = dir_entry.stat()
+                found.append(CacheEntry(key, dir_entry.path, stat.st_size, last_used=stat.st_mtime))
+
+        for entry in sorted(found, key=lambda e: e.last_used):
+            metadata = self.__read_metadata(entry.key)
+            if metadata is not None:
+                entry.hits = metadata.get("hits", 0)
+                entry.loudness = metadata.get("loudness")
+            self.__entries[entry.key] = entry
+            self.__size += entry.size
+
+        logging.getLogger().log(logging.INFO, f"Indexed {len(self.__entries)} cached files ({self.__size} bytes)")
+        self.evict()
+
+    async def lookup(self, key):
+        """Returns the stored metadata for a key if its audio file is cached, otherwise None"""
+
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        metadata = self.__unwritten.get(key)
+        if metadata is None:
+            if self.io is not None:
+                exists, metadata = await self.io.run(self.__read_cached, key, entry.filepath)
+            else:
+                exists, metadata = self.__read_cached(key, entry.filepath)
+            if self.__entries.get(key) is not entry:
+                # Evicted or downloaded again while the files were read
+                return await self.lookup(key)
+            if not exists:
+                self.__remove_entry(entry)
+            if metadata is None:
+                self.misses += 1
+                return None
+
+        self.hits += 1
+        self.touch(key)
+        return metadata
+
+    def add(self, key, filepath, metadata, size=None):
+        """Adds a freshly downloaded file to the cache and evicts old entries if the cache is over budget. size is
+        looked up if the caller doesn't know it"""
+
+        if key in self.__entries:
+            self.__remove_entry(self.__entries[key], delete_files=False)
+        if self.io is not None:
+            # It might have been evicted and downloaded again before its deletion got to run
+            self.io.cancel_delete(filepath, self.metadata_path(key))
+
+        if size is None:
+            size = os.path.getsize(filepath)
+        entry = CacheEntry(key, filepath, size, hits=1, loudness=metadata.get("loudness"))
+        self.__entries[key] = entry
+        self.__size += entry.size
+        self.__write_metadata(key, dict(metadata, hits=entry.hits))
+        self.evict(keep=key)
+
+    def touch(self, key):
+        entry = self.__entries.get(key)
+        if entry is None:
+            return
+        entry.hits += 1
+        entry.last_used = time.time()
+        self.__entries.move_to_end(key)
+        if self.io is not None:
+            self.io.submit(self.__touch_file, entry.filepath)
+        else:
+            self.__touch_file(entry.filepath)
+
+    @staticmethod
+    def __touch_file(filepath):
+        try:
+            os.utime(filepath)
+        except OSError:
+            pass
+
+    def release(self, key):
+        """Called when a key is no longer queued or playing, making it a candidate for eviction"""
+
+        self.evict()
+
+    def evict(self, keep=None):
+        if self.__size <= self.max_bytes:
+            return
+
+        candidates = list(self.__entries.values())
+        if self.policy == "lfu":
+            candidates.sort(key=lambda e: (e.hits, e.last_used))
+
+        for entry in candidates:
+            if self.__size <= self.max_bytes:
+                break
+            if entry.key == keep or self.is_pinned(entry.key):
+                continue
+            self.__remove_entry(entry)
+            logging.getLogger().log(logging.INFO, f"Evicted {entry.key} from the audio cache")
+
+    def __remove_entry(self, entry, delete_files=True):
+        del self.__entries[entry.key]
+        self.__size -= entry.size
+        if not delete_files:
+            return
+
+        paths = (entry.filepath, self.metadata_path(entry.key))
+        if self.io is not None:
+            with self.__unwritten_lock:
+                self.__unwritten.pop(entry.key, None)
+            return self.io.delete(*paths)
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logging.getLogger().log(logging.ERROR, f"Error deleting file. Message: {e}")
+
+    def __read_cached(self, key, filepath):
+        """Whether the audio file is still there, and its metadata"""
+
+        if not os.path.exists(filepath):
+            return False, None
+        return True, self.__read_metadata(key)
+
+    def __read_metadata(self, key):
+        try:
+            with open(self.metadata_path(key), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def __write_metadata(self, key, metadata):
+        if self.io is None:
+            return self.__write_metadata_file(key, metadata)
+        with self.__unwritten_lock:
+            self.__unwritten[key] = metadata
+        self.io.submit(self.__write_metadata_file, key, metadata)
+
+    def __write_metadata_file(self, key, metadata):
+        if self.io is not None:
+            with self.__unwritten_lock:
+                if self.__unwritten.get(key) is not metadata:
+                    # Evicted or written again since, writing this one would leave a stale sidecar behind
+                    return
+        try:
+            with open(self.metadata_path(key), "w") as f:
+                json.dump(metadata, f)
+        except OSError as e:
+            logging.getLogger().log(logging.ERROR, f"Error writing cache metadata. Message: {e}")
+        finally:
+            with self.__unwritten_lock:
+                if self.__unwritten.get(key) is metadata:
+                    del self.__unwritten[key]
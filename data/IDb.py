@@ -14,6 +14,9 @@ class IDb(abc.ABC):
     def get_now_playing_with_guild_id(self, guild_id):
         pass
 
+    def get_queue_slice(self, guild_id, start, stop):
+        pass
+
     def add_to_queue(self, guild_id, item):
         pass
 
@@ -38,6 +41,9 @@ class IDb(abc.ABC):
     def queue_size(self, guild_id):
         pass
 
+    def queue_version(self, guild_id):
+        pass
+
     def clean_up_for_guild_id(self, guild_id):
         pass
 
@@ -50,6 +56,9 @@ class IDb(abc.ABC):
     def pop_index_from_queue(self, index, guild_id):
         pass
 
+    def advance_queue(self, guild_id):
+        pass
+
     def queue_swap(self, guild_id, index1, index2):
         pass
 
@@ -59,8 +68,38 @@ class IDb(abc.ABC):
     def queue_move(self, guild_id, original_index, new_index):
         pass
 
+    def queue_remove_range(self, guild_id, start_index, end_index):
+        pass
+
+    def queue_shuffle(self, guild_id):
+        pass
+
+    def queue_dedupe(self, guild_id):
+        pass
+
     def player_in_any_queue(self, player):
         pass
 
     def player_in_any_now_playing(self, player):
         pass
+
+    def set_release_callback(self, callback):
+        pass
+
+    def is_track_referenced(self, key):
+        pass
+
+    def track_reference_count(self, key):
+        pass
+
+    def get_sessions(self):
+        pass
+
+    def set_session(self, guild_id, voice_channel_id, text_channel_id):
+        pass
+
+    def delete_session(self, guild_id):
+        pass
+
+    def close(self):
+        pass
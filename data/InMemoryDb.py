@@ -1,46 +1,101 @@
 from .IDb import IDb
+from .TrackQueue import TrackQueue
 
 
 class InMemoryDb(IDb):
     def __init__(self):
         self.__queues = {}
         self.__now_playings = {}
+        # Number of queue and now playing entries referencing each track key
+        self.__references = {}
+        self.__on_track_released = None
+        # guild id -> (voice channel id, text channel id) of guilds the bot is playing in
+        self.__sessions = {}
+        # Bumped on every change to a guild's queue, so views of the queue know when they are out of date
+        self.__versions = {}
+
+    def set_release_callback(self, callback):
+        self.__on_track_released = callback
+
+    def __changed(self, guild_id):
+        self.__versions[guild_id] = self.__versions.get(guild_id, 0) + 1
+
+    def queue_version(self, guild_id):
+        return self.__versions.get(guild_id, 0)
+
+    def __reference(self, item):
+        self.__references[item.key] = self.__references.get(item.key, 0) + 1
+
+    def __dereference(self, item):
+        count = self.__references[item.key] - 1
+        if count > 0:
+            self.__references[item.key] = count
+            return
+
+        del self.__references[item.key]
+        if self.__on_track_released is not None:
+            self.__on_track_released(item.key)
 
     def get_queues(self):
-        return self.__queues
+        return {guild_id: tuple(queue) for guild_id, queue in self.__queues.items()}
 
     def get_all_now_playings(self):
-        return self.__now_playings
+        return dict(self.__now_playings)
 
     def get_queue_with_guild_id(self, guild_id):
+        """Returns a snapshot of the queue, changes to the queue have to go through the db"""
+
         if guild_id in self.__queues:
-            return self.__queues[guild_id]
+            return tuple(self.__queues[guild_id])
         return None
 
+    def get_queue_slice(self, guild_id, start, stop):
+        """Returns the items from 0 based position start up to but not including stop"""
+
+        if guild_id in self.__queues:
+            return self.__queues[guild_id].slice(start, stop)
+        return []
+
     def get_now_playing_with_guild_id(self, guild_id):
         if guild_id in self.__now_playings:
             return self.__now_playings[guild_id]
         return None
 
     def add_to_queue(self, guild_id, item):
+        self.__changed(guild_id)
+        self.__reference(item)
         if guild_id in self.__queues:
             self.__queues[guild_id].append(item)
         else:
-            self.__queues[guild_id] = [item]
+            self.__queues[guild_id] = TrackQueue([item])
 
     def set_queue(self, guild_id, queue):
-        self.__queues[guild_id] = queue
+        self.__changed(guild_id)
+        # Reference the new items before releasing the old ones so items in both are never released
+        for item in queue:
+            self.__reference(item)
+        old_queue = self.__queues.get(guild_id, [])
+        self.__queues[guild_id] = TrackQueue(queue)
+        for item in old_queue:
+            self.__dereference(item)
 
     def set_now_playing(self, guild_id, now_playing):
+        self.__reference(now_playing)
+        old_now_playing = self.__now_playings.get(guild_id)
         self.__now_playings[guild_id] = now_playing
+        if old_now_playing is not None:
+            self.__dereference(old_now_playing)
 
     def delete_queue(self, guild_id):
+        self.__changed(guild_id)
         if guild_id in self.__queues:
-            del self.__queues[guild_id]
+            queue = self.__queues.pop(guild_id)
+            for item in queue:
+                self.__dereference(item)
 
     def delete_now_playing(self, guild_id):
         if guild_id in self.__now_playings:
-            del self.__now_playings[guild_id]
+            self.__dereference(self.__now_playings.pop(guild_id))
 
     def guild_id_in_queues(self, guild_id):
         return guild_id in self.__queues
@@ -64,46 +119,111 @@ class InMemoryDb(IDb):
         return 1 <= index <= self.queue_size(guild_id)
 
     def pop_index_from_queue(self, index, guild_id):
+        self.__changed(guild_id)
         if not self.is_there_item_in_queue_for_guild_id(guild_id) or not self.is_index_valid(index, guild_id):
             return None
-        return self.__queues[guild_id].pop(index - 1)
+        item = self.__queues[guild_id].pop(index - 1)
+        self.__dereference(item)
+        return item
+
+    def advance_queue(self, guild_id):
+        """Moves the first item of the queue to now playing and returns it"""
+
+        self.__changed(guild_id)
+        if not self.is_there_item_in_queue_for_guild_id(guild_id):
+            return None
+
+        item = self.__queues[guild_id][0]
+        self.set_now_playing(guild_id, item)
+        self.__queues[guild_id].popleft()
+        self.__dereference(item)
+        return item
 
     def queue_swap(self, guild_id, index1, index2):
+        self.__changed(guild_id)
         if (not self.is_there_item_in_queue_for_guild_id(guild_id) or not self.is_index_valid(index1, guild_id)
                 or not self.is_index_valid(index2, guild_id)):
             return False
 
-        position1 = index1 - 1
-        position2 = index2 - 1
-
-        temp = self.__queues[guild_id][position1]
-        self.__queues[guild_id][position1] = self.__queues[guild_id][position2]
-        self.__queues[guild_id][position2] = temp
+        self.__queues[guild_id].swap(index1 - 1, index2 - 1)
         return True
 
     def queue_jump(self, guild_id, index):
+        self.__changed(guild_id)
         if not self.is_there_item_in_queue_for_guild_id(guild_id) or not self.is_index_valid(index, guild_id):
             return False
 
-        del self.__queues[guild_id][:index - 1]
+        for item in self.__queues[guild_id].remove_range(0, index - 1):
+            self.__dereference(item)
         return True
 
     def queue_move(self, guild_id, original_index, new_index):
+        self.__changed(guild_id)
         if (not self.is_there_item_in_queue_for_guild_id(guild_id) or not self.is_index_valid(original_index, guild_id)
                 or not self.is_index_valid(new_index, guild_id)):
             return False
 
-        player = self.__queues[guild_id].pop(original_index - 1)
-        self.__queues[guild_id].insert(new_index - 1, player)
+        self.__queues[guild_id].move(original_index - 1, new_index - 1)
         return True
 
+    def queue_remove_range(self, guild_id, start_index, end_index):
+        """Removes the items from start_index to end_index, both included, and returns them"""
+
+        self.__changed(guild_id)
+        if (not self.is_there_item_in_queue_for_guild_id(guild_id) or not self.is_index_valid(start_index, guild_id)
+                or not self.is_index_valid(end_index, guild_id) or start_index > end_index):
+            return None
+
+        removed = self.__queues[guild_id].remove_range(start_index - 1, end_index)
+        for item in removed:
+            self.__dereference(item)
+        return removed
+
+    def queue_shuffle(self, guild_id):
+        self.__changed(guild_id)
+        if not self.is_there_item_in_queue_for_guild_id(guild_id):
+            return False
+
+        self.__queues[guild_id].shuffle()
+        return True
+
+    def queue_dedupe(self, guild_id):
+        """Removes repeats of tracks that are already earlier in the queue and returns the removed items"""
+
+        self.__changed(guild_id)
+        if not self.is_there_item_in_queue_for_guild_id(guild_id):
+            return []
+
+        removed = self.__queues[guild_id].dedupe(lambda item: item.key)
+        for item in removed:
+            self.__dereference(item)
+        return removed
+
     def player_in_any_queue(self, player):
         for queue in self.__queues.values():
             for item in queue:
-                if player.title == item.title and player.data["original_url"] == item.data["original_url"]:
+                if player.key == item.key:
                     return True
         return False
 
     def player_in_any_now_playing(self, player):
-        return any(player.title == queue_item.title and player.data["original_url"] == queue_item.data["original_url"]
-                   for queue_item in self.__now_playings.values())
+        return any(player.key == queue_item.key for queue_item in self.__now_playings.values())
+
+    def is_track_referenced(self, key):
+        return key in self.__references
+
+    def track_reference_count(self, key):
+        return self.__references.get(key, 0)
+
+    def get_sessions(self):
+        return dict(self.__sessions)
+
+    def set_session(self, guild_id, voice_channel_id, text_channel_id):
+        self.__sessions[guild_id] = (voice_channel_id, text_channel_id)
+
+    def delete_session(self, guild_id):
+        if guild_id in self.__sessions:
+            del self.__sessions[guild_id]
+
+    def close(self):
+        pass
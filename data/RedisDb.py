@@ -0,0 +1,235 @@
+import json
+from dataclasses import asdict
+import redis
+from .InMemoryDb import InMemoryDb
+from .Track import Track
+
+
+class RedisDb(InMemoryDb):
+    """InMemoryDb written through to Redis so that several bot processes, each running a range of shards, share
+    their state.
+
+    Each guild's queue and now playing are only ever changed by the process running that guild's shard, so reads are
+    served by the in-memory data and every change costs a single round trip to write it through. Redis is only read
+    when the process starts. The track reference counts are shared by every process, so the audio cache directory
+    can be shared too: a file is only evicted once no guild on any process has it queued or playing.
+    """
+
+    removed = "__removed__"
+
+    def __init__(self, url, prefix="musicbot"):
+        super().__init__()
+        self.__redis = redis.Redis.from_url(url)
+        self.__prefix = prefix
+        self.__queue_guilds_key = f"{prefix}:queue_guilds"
+        self.__now_playings_key = f"{prefix}:now_playings"
+        self.__references_key = f"{prefix}:references"
+        self.__sessions_key = f"{prefix}:sessions"
+        self.__on_track_released = None
+        self.__load_all()
+
+    def __queue_key(self, guild_id):
+        return f"{self.__prefix}:queue:{guild_id}"
+
+    @staticmethod
+    def __dump(track):
+        return json.dumps(asdict(track))
+
+    @staticmethod
+    def __load(value):
+        return Track(**json.loads(value))
+
+    def __load_all(self):
+        # The in-memory methods of the base class, Redis already has the data and its reference counts
+        guild_ids = [int(guild_id) for guild_id in self.__redis.smembers(self.__queue_guilds_key)]
+        pipeline = self.__redis.pipeline()
+        for guild_id in guild_ids:
+            pipeline.lrange(self.__queue_key(guild_id), 0, -1)
+        for guild_id, values in zip(guild_ids, pipeline.execute()):
+            super().set_queue(guild_id, [self.__load(value) for value in values])
+        for guild_id, value in self.__redis.hgetall(self.__now_playings_key).items():
+            super().set_now_playing(int(guild_id), self.__load(value))
+        for guild_id, value in self.__redis.hgetall(self.__sessions_key).items():
+            super().set_session(int(guild_id), *json.loads(value))
+
+    def set_release_callback(self, callback):
+        # Tracks are released when no process references them anymore, not when this one stops
+        self.__on_track_released = callback
+
+    def __execute(self, pipeline, referenced=(), dereferenced=()):
+        """Runs the pipeline together with the reference count changes of the tracks that were added and removed"""
+
+        # Counted up before down, so a track that is both added and removed is never released
+        for item in referenced:
+            pipeline.hincrby(self.__references_key, item.key, 1)
+        for item in dereferenced:
+            pipeline.hincrby(self.__references_key, item.key, -1)
+        results = pipeline.execute()
+
+        counts = results[len(results) - len(dereferenced):]
+        for item, count in zip(dereferenced, counts):
+            if count > 0:
+                continue
+            # Only delete the count if no other process referenced the track in the meantime
+            self.__redis.eval(
+                "if tonumber(redis.call('HGET', KEYS[1], ARGV[1]) or '0') <= 0 then "
+                "return redis.call('HDEL', KEYS[1], ARGV[1]) end return 0",
+                1, self.__references_key, item.key
+            )
+            if self.__on_track_released is not None:
+                self.__on_track_released(item.key)
+
+    def __rewrite_queue(self, guild_id, dereferenced=()):
+        """Writes the whole queue of the guild from memory"""
+
+        key = self.__queue_key(guild_id)
+        pipeline = self.__redis.pipeline()
+        pipeline.delete(key)
+        queue = self.get_queue_with_guild_id(guild_id)
+        if queue:
+            pipeline.rpush(key, *[self.__dump(item) for item in queue])
+        self.__execute(pipeline, dereferenced=dereferenced)
+
+    def add_to_queue(self, guild_id, item):
+        super().add_to_queue(guild_id, item)
+        pipeline = self.__redis.pipeline()
+        pipeline.rpush(self.__queue_key(guild_id), self.__dump(item))
+        pipeline.sadd(self.__queue_guilds_key, guild_id)
+        self.__execute(pipeline, referenced=[item])
+
+    def set_queue(self, guild_id, queue):
+        queue = list(queue)
+        old_queue = self.get_queue_with_guild_id(guild_id) or ()
+        super().set_queue(guild_id, queue)
+
+        key = self.__queue_key(guild_id)
+        pipeline = self.__redis.pipeline()
+        pipeline.delete(key)
+        if queue:
+            pipeline.rpush(key, *[self.__dump(item) for item in queue])
+        pipeline.sadd(self.__queue_guilds_key, guild_id)
+        self.__execute(pipeline, referenced=queue, dereferenced=old_queue)
+
+    def set_now_playing(self, guild_id, now_playing):
+        old_now_playing = self.get_now_playing_with_guild_id(guild_id)
+        super().set_now_playing(guild_id, now_playing)
+
+        pipeline = self.__redis.pipeline()
+        pipeline.hset(self.__now_playings_key, guild_id, self.__dump(now_playing))
+        self.__execute(pipeline, referenced=[now_playing],
+                       dereferenced=[old_now_playing] if old_now_playing is not None else [])
+
+    def delete_queue(self, guild_id):
+        queue = self.get_queue_with_guild_id(guild_id)
+        super().delete_queue(guild_id)
+        if queue is None:
+            return
+
+        pipeline = self.__redis.pipeline()
+        pipeline.delete(self.__queue_key(guild_id))
+        pipeline.srem(self.__queue_guilds_key, guild_id)
+        self.__execute(pipeline, dereferenced=queue)
+
+    def delete_now_playing(self, guild_id):
+        now_playing = self.get_now_playing_with_guild_id(guild_id)
+        super().delete_now_playing(guild_id)
+        if now_playing is None:
+            return
+
+        pipeline = self.__redis.pipeline()
+        pipeline.hdel(self.__now_playings_key, guild_id)
+        self.__execute(pipeline, dereferenced=[now_playing])
+
+    def pop_index_from_queue(self, index, guild_id):
+        item = super().pop_index_from_queue(index, guild_id)
+        if item is None:
+            return None
+
+        # Redis lists can't delete by index, so the item is replaced with a marker which is then removed
+        pipeline = self.__redis.pipeline()
+        pipeline.lset(self.__queue_key(guild_id), index - 1, self.removed)
+        pipeline.lrem(self.__queue_key(guild_id), 1, self.removed)
+        self.__execute(pipeline, dereferenced=[item])
+        return item
+
+    def advance_queue(self, guild_id):
+        if not self.is_there_item_in_queue_for_guild_id(guild_id):
+            return super().advance_queue(guild_id)
+
+        # The base class methods, so the move from the queue to now playing is written in one go
+        old_now_playing = self.get_now_playing_with_guild_id(guild_id)
+        item = super().pop_index_from_queue(1, guild_id)
+        super().set_now_playing(guild_id, item)
+
+        pipeline = self.__redis.pipeline()
+        pipeline.lpop(self.__queue_key(guild_id))
+        pipeline.hset(self.__now_playings_key, guild_id, self.__dump(item))
+        self.__execute(pipeline, dereferenced=[old_now_playing] if old_now_playing is not None else [])
+        return item
+
+    def queue_swap(self, guild_id, index1, index2):
+        if not super().queue_swap(guild_id, index1, index2):
+            return False
+
+        key = self.__queue_key(guild_id)
+        pipeline = self.__redis.pipeline()
+        for index in (index1, index2):
+            pipeline.lset(key, index - 1, self.__dump(self.get_queue_slice(guild_id, index - 1, index)[0]))
+        self.__execute(pipeline)
+        return True
+
+    def queue_jump(self, guild_id, index):
+        removed = self.get_queue_slice(guild_id, 0, index - 1)
+        if not super().queue_jump(guild_id, index):
+            return False
+
+        pipeline = self.__redis.pipeline()
+        pipeline.ltrim(self.__queue_key(guild_id), index - 1, -1)
+        self.__execute(pipeline, dereferenced=removed)
+        return True
+
+    def queue_move(self, guild_id, original_index, new_index):
+        if not super().queue_move(guild_id, original_index, new_index):
+            return False
+
+        self.__rewrite_queue(guild_id)
+        return True
+
+    def queue_remove_range(self, guild_id, start_index, end_index):
+        removed = super().queue_remove_range(guild_id, start_index, end_index)
+        if removed is None:
+            return None
+
+        self.__rewrite_queue(guild_id, dereferenced=removed)
+        return removed
+
+    def queue_shuffle(self, guild_id):
+        if not super().queue_shuffle(guild_id):
+            return False
+
+        self.__rewrite_queue(guild_id)
+        return True
+
+    def queue_dedupe(self, guild_id):
+        removed = super().queue_dedupe(guild_id)
+        if removed:
+            self.__rewrite_queue(guild_id, dereferenced=removed)
+        return removed
+
+    def is_track_referenced(self, key):
+        return self.track_reference_count(key) > 0
+
+    def track_reference_count(self, key):
+        count = self.__redis.hget(self.__references_key, key)
+        return int(count) if count is not None else 0
+
+    def set_session(self, guild_id, voice_channel_id, text_channel_id):
+        super().set_session(guild_id, voice_channel_id, text_channel_id)
+        self.__redis.hset(self.__sessions_key, guild_id, json.dumps([voice_channel_id, text_channel_id]))
+
+    def delete_session(self, guild_id):
+        super().delete_session(guild_id)
+        self.__redis.hdel(self.__sessions_key, guild_id)
+
+    def close(self):
+        self.__redis.close()
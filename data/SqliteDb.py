@@ -0,0 +1,242 @@
+import asyncio
+import logging
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from .InMemoryDb import InMemoryDb
+from .Track import Track
+
+
+class SqliteDb(InMemoryDb):
+    """InMemoryDb that is persisted to SQLite so queues survive restarts.
+
+    Reads are served by the in-memory data. Writes are collected and written in one transaction after
+    flush_interval seconds, on a thread of their own so the event loop never waits for the disk.
+
+    Queue rows keep increasing positions that may have gaps, so taking songs from the front or appending them
+    only touches those rows. Other changes to a queue rewrite it.
+    """
+
+    track_columns = "key, id, title, original_url, duration"
+    insert_queue_item = f"INSERT INTO queue_items (guild_id, position, {track_columns}) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+    def __init__(self, path, flush_interval=1.0):
+        super().__init__()
+        self.flush_interval = flush_interval
+        # guild id -> statements to apply to the guild's queue rows, in order
+        self.__queue_changes = {}
+        # Guilds whose whole queue is written again, any statements for them are left out
+        self.__queue_rewrites = set()
+        self.__dirty_now_playings = set()
+        self.__dirty_sessions = set()
+        # guild id -> position of the first item of the guild's queue in queue_items
+        self.__first_positions = {}
+        self.__flush_handle = None
+
+        self.__writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite-db")
+        # Only used by the writer thread once the data is loaded
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.executescript(f"""
+            CREATE TABLE IF NOT EXISTS queue_items (
+                guild_id INTEGER NOT NULL, position INTEGER NOT NULL, {self.track_columns},
+                PRIMARY KEY (guild_id, position)
+            );
+            CREATE TABLE IF NOT EXISTS now_playings (guild_id INTEGER PRIMARY KEY, {self.track_columns});
+            CREATE TABLE IF NOT EXISTS sessions (
+                guild_id INTEGER PRIMARY KEY, voice_channel_id INTEGER NOT NULL, text_channel_id INTEGER NOT NULL
+            );
+        """)
+        self.__connection.commit()
+        self.__load()
+
+    def __load(self):
+        for guild_id, position, *track in self.__connection.execute(
+                f"SELECT guild_id, position, {self.track_columns} FROM queue_items ORDER BY guild_id, position"):
+            self.__first_positions.setdefault(guild_id, position)
+            super().add_to_queue(guild_id, Track(*track))
+        for guild_id, *track in self.__connection.execute(f"SELECT guild_id, {self.track_columns} FROM now_playings"):
+            super().set_now_playing(guild_id, Track(*track))
+        for guild_id, voice_channel_id, text_channel_id in self.__connection.execute("SELECT * FROM sessions"):
+            super().set_session(guild_id, voice_channel_id, text_channel_id)
+
+    @staticmethod
+    def __track_row(track):
+        return track.key, track.id, track.title, track.original_url, track.duration
+
+    def __schedule_flush(self):
+        if self.__flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not running inside the bot, nothing to batch with
+            return self.flush().result()
+        self.__flush_handle = loop.call_later(self.flush_interval, self.flush)
+
+    def __queue_changed(self, guild_id, statement=None, parameters=()):
+        """Records a change to a guild's queue, a statement applying it or None to rewrite the queue"""
+
+        if statement is None:
+            self.__queue_rewrites.add(guild_id)
+            self.__queue_changes.pop(guild_id, None)
+        elif guild_id not in self.__queue_rewrites:
+            self.__queue_changes.setdefault(guild_id, []).append((statement, parameters))
+        self.__schedule_flush()
+
+    def __now_playing_changed(self, guild_id):
+        self.__dirty_now_playings.add(guild_id)
+        self.__schedule_flush()
+
+    def __session_changed(self, guild_id):
+        self.__dirty_sessions.add(guild_id)
+        self.__schedule_flush()
+
+    def __removed_from_front(self, guild_id, count):
+        first_position = self.__first_positions.get(guild_id, 0)
+        self.__first_positions[guild_id] = first_position + count
+        self.__queue_changed(guild_id, "DELETE FROM queue_items WHERE guild_id = ? AND position < ?",
+                             (guild_id, first_position + count))
+
+    def flush(self):
+        """Hands every change made since the last flush to the writer thread, which writes them in a single
+        transaction. Returns the future of the write"""
+
+        if self.__flush_handle is not None:
+            self.__flush_handle.cancel()
+            self.__flush_handle = None
+
+        # The data is copied here, the rows are only built on the writer thread
+        statements = [statement for changes in self.__queue_changes.values() for statement in changes]
+        rewrites = {}
+        for guild_id in self.__queue_rewrites:
+            rewrites[guild_id] = self.get_queue_with_guild_id(guild_id) or ()
+            self.__first_positions[guild_id] = 0
+        now_playings = {guild_id: self.get_now_playing_with_guild_id(guild_id)
+                        for guild_id in self.__dirty_now_playings}
+        sessions = self.get_sessions()
+        sessions = {guild_id: sessions.get(guild_id) for guild_id in self.__dirty_sessions}
+        self.__queue_changes = {}
+        self.__queue_rewrites = set()
+        self.__dirty_now_playings = set()
+        self.__dirty_sessions = set()
+
+        future = self.__writer.submit(self.__write, statements, rewrites, now_playings, sessions)
+        future.add_done_callback(self.__log_failure)
+        return future
+
+    def __write(self, statements, rewrites, now_playings, sessions):
+        with self.__connection:
+            for statement, parameters in statements:
+                self.__connection.execute(statement, parameters)
+            for guild_id, queue in rewrites.items():
+                self.__connection.execute("DELETE FROM queue_items WHERE guild_id = ?", (guild_id,))
+                self.__connection.executemany(
+                    self.insert_queue_item,
+                    [(guild_id, position, *self.__track_row(track)) for position, track in enumerate(queue)]
+                )
+            for guild_id, now_playing in now_playings.items():
+                if now_playing is None:
+                    self.__connection.execute("DELETE FROM now_playings WHERE guild_id = ?", (guild_id,))
+                else:
+                    self.__connection.execute(
+                        f"INSERT OR REPLACE INTO now_playings (guild_id, {self.track_columns}) "
+                        f"VALUES (?, ?, ?, ?, ?, ?)",
+                        (guild_id, *self.__track_row(now_playing))
+                    )
+            for guild_id, session in sessions.items():
+                if session is None:
+                    self.__connection.execute("DELETE FROM sessions WHERE guild_id = ?", (guild_id,))
+                else:
+                    self.__connection.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (guild_id, *session))
+
+    @staticmethod
+    def __log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logging.getLogger().log(logging.ERROR, f"Error writing to the database. Message: {future.exception()}")
+
+    def close(self):
+        self.flush()
+        self.__writer.shutdown(wait=True)
+        self.__connection.close()
+
+    def add_to_queue(self, guild_id, item):
+        super().add_to_queue(guild_id, item)
+        position = self.__first_positions.setdefault(guild_id, 0) + self.queue_size(guild_id) - 1
+        self.__queue_changed(guild_id, self.insert_queue_item, (guild_id, position, *self.__track_row(item)))
+
+    def set_queue(self, guild_id, queue):
+        super().set_queue(guild_id, queue)
+        self.__queue_changed(guild_id)
+
+    def set_now_playing(self, guild_id, now_playing):
+        super().set_now_playing(guild_id, now_playing)
+        self.__now_playing_changed(guild_id)
+
+    def delete_queue(self, guild_id):
+        super().delete_queue(guild_id)
+        self.__first_positions.pop(guild_id, None)
+        self.__queue_changed(guild_id, "DELETE FROM queue_items WHERE guild_id = ?", (guild_id,))
+
+    def delete_now_playing(self, guild_id):
+        super().delete_now_playing(guild_id)
+        self.__now_playing_changed(guild_id)
+
+    def pop_index_from_queue(self, index, guild_id):
+        item = super().pop_index_from_queue(index, guild_id)
+        if item is not None:
+            if index == 1:
+                self.__removed_from_front(guild_id, 1)
+            else:
+                self.__queue_changed(guild_id)
+        return item
+
+    def advance_queue(self, guild_id):
+        item = super().advance_queue(guild_id)
+        if item is not None:
+            self.__removed_from_front(guild_id, 1)
+        return item
+
+    def queue_swap(self, guild_id, index1, index2):
+        result = super().queue_swap(guild_id, index1, index2)
+        if result:
+            self.__queue_changed(guild_id)
+        return result
+
+    def queue_jump(self, guild_id, index):
+        result = super().queue_jump(guild_id, index)
+        if result:
+            self.__removed_from_front(guild_id, index - 1)
+        return result
+
+    def queue_move(self, guild_id, original_index, new_index):
+        result = super().queue_move(guild_id, original_index, new_index)
+        if result:
+            self.__queue_changed(guild_id)
+        return result
+
+    def queue_remove_range(self, guild_id, start_index, end_index):
+        removed = super().queue_remove_range(guild_id, start_index, end_index)
+        if removed:
+            self.__queue_changed(guild_id)
+        return removed
+
+    def queue_shuffle(self, guild_id):
+        result = super().queue_shuffle(guild_id)
+        if result:
+            self.__queue_changed(guild_id)
+        return result
+
+    def queue_dedupe(self, guild_id):
+        removed = super().queue_dedupe(guild_id)
+        if removed:
+            self.__queue_changed(guild_id)
+        return removed
+
+    def set_session(self, guild_id, voice_channel_id, text_channel_id):
+        super().set_session(guild_id, voice_channel_id, text_channel_id)
+        self.__session_changed(guild_id)
+
+    def delete_session(self, guild_id):
+        super().delete_session(guild_id)
+        self.__session_changed(guild_id)
@@ -0,0 +1,27 @@
+from dataclasses import dataclass
+
+
+@dataclass(slots=True)
+class Track:
+    """Lightweight queue entry. The audio source is only created from it when the track starts playing"""
+
+    key: str
+    id: str
+    title: str
+    original_url: str
+    duration: float = None
+    filepath: str = None
+    # Integrated loudness in LUFS, measured when the track is downloaded
+    loudness: float = None
+
+    @classmethod
+    def from_info(cls, key, info, filepath=None):
+        return cls(
+            key=key,
+            id=info.get('id'),
+            title=info.get('title'),
+            original_url=info.get('original_url') or info.get('webpage_url'),
+            duration=info.get('duration'),
+            filepath=filepath,
+            loudness=info.get('loudness'),
+        )
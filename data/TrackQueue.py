@@ -0,0 +1,205 @@
+import random
+from collections import deque
+from itertools import islice
+
+
+class TrackQueue:
+    """Sequence of tracks split into blocks of a few hundred items, with a Fenwick tree over the block sizes.
+
+    Taking the next track is O(1), finding, inserting or removing a position is O(log n) plus a copy of at most one
+    block. Positions are 0 based, the db converts from the 1 based positions shown to users.
+    """
+
+    load = 256
+
+    def __init__(self, items=()):
+        self.__blocks = []
+        self.__tree = []
+        self.__length = 0
+        self.__rebuild(list(items))
+
+    def __len__(self):
+        return self.__length
+
+    def __iter__(self):
+        for block in self.__blocks:
+            yield from block
+
+    def __getitem__(self, index):
+        block, offset = self.__locate(index)
+        return self.__blocks[block][offset]
+
+    def __setitem__(self, index, item):
+        block, offset = self.__locate(index)
+        self.__blocks[block][offset] = item
+
+    def __repr__(self):
+        return f"TrackQueue({list(self)!r})"
+
+    def slice(self, start, stop):
+        """Copy of the items from start up to but not including stop"""
+
+        start, stop, _ = slice(start, stop).indices(self.__length)
+        items = []
+        if start >= stop:
+            return items
+
+        block, offset = self.__locate(start)
+        while len(items) < stop - start:
+            current = self.__blocks[block]
+            take = min(len(current) - offset, stop - start - len(items))
+            items.extend(islice(current, offset, offset + take))
+            block, offset = block + 1, 0
+        return items
+
+    def append(self, item):
+        if not self.__blocks or len(self.__blocks[-1]) >= self.load:
+            self.__blocks.append(deque())
+            self.__rebuild_tree()
+        self.__blocks[-1].append(item)
+        self.__add(len(self.__blocks) - 1, 1)
+
+    def extend(self, items):
+        for item in items:
+            self.append(item)
+
+    def popleft(self):
+        if self.__length == 0:
+            raise IndexError("pop from an empty queue")
+
+        item = self.__blocks[0].popleft()
+        self.__add(0, -1)
+        if not self.__blocks[0]:
+            del self.__blocks[0]
+            self.__rebuild_tree()
+        return item
+
+    def pop(self, index):
+        block, offset = self.__locate(index)
+        current = self.__blocks[block]
+        item = current[offset]
+        del current[offset]
+        self.__add(block, -1)
+        if not current:
+            del self.__blocks[block]
+            self.__rebuild_tree()
+        return item
+
+    def insert(self, index, item):
+        if index >= self.__length:
+            return self.append(item)
+
+        block, offset = self.__locate(index)
+        current = self.__blocks[block]
+        current.insert(offset, item)
+        self.__add(block, 1)
+        if len(current) > 2 * self.load:
+            # Split oversized blocks so inserts stay cheap
+            tail = deque()
+            while len(current) > self.load:
+                tail.appendleft(current.pop())
+            self.__blocks.insert(block + 1, tail)
+            self.__rebuild_tree()
+
+    def move(self, original_index, new_index):
+        self.insert(new_index, self.pop(original_index))
+
+    def swap(self, index1, index2):
+        self[index1], self[index2] = self[index2], self[index1]
+
+    def remove_range(self, start, stop):
+        """Removes the items from start up to but not including stop and returns them"""
+
+        start, stop, _ = slice(start, stop).indices(self.__length)
+        if start >= stop:
+            return []
+
+        first, begin = self.__locate(start)
+        last, end = self.__locate(stop - 1)
+        if first == last:
+            removed = self.__cut(first, begin, end + 1)
+            if self.__blocks[first]:
+                self.__add(first, -len(removed))
+                return removed
+        else:
+            # Blocks fully inside the range are dropped whole, only the two at its ends are trimmed
+            removed = self.__cut(first, begin, len(self.__blocks[first]))
+            for block in self.__blocks[first + 1:last]:
+                removed.extend(block)
+            removed.extend(self.__cut(last, 0, end + 1))
+            del self.__blocks[first + 1:last]
+        self.__blocks = [block for block in self.__blocks if block]
+        self.__rebuild_tree()
+        return removed
+
+    def shuffle(self):
+        items = list(self)
+        random.shuffle(items)
+        self.__rebuild(items)
+
+    def dedupe(self, key):
+        """Keeps only the first item for each key and returns the removed items"""
+
+        seen = set()
+        kept = []
+        removed = []
+        for item in self:
+            if key(item) in seen:
+                removed.append(item)
+            else:
+                seen.add(key(item))
+                kept.append(item)
+        self.__rebuild(kept)
+        return removed
+
+    def clear(self):
+        self.__rebuild([])
+
+    def __cut(self, block, begin, end):
+        """Removes the items from begin up to but not including end of one block in place and returns them"""
+
+        current = self.__blocks[block]
+        current.rotate(-begin)
+        removed = [current.popleft() for _ in range(end - begin)]
+        current.rotate(begin)
+        return removed
+
+    def __rebuild(self, items):
+        self.__blocks = [deque(items[i:i + self.load]) for i in range(0, len(items), self.load)]
+        self.__rebuild_tree()
+
+    def __rebuild_tree(self):
+        size = len(self.__blocks)
+        self.__tree = [0] * (size + 1)
+        for i, block in enumerate(self.__blocks, start=1):
+            self.__tree[i] += len(block)
+            parent = i + (i & -i)
+            if parent <= size:
+                self.__tree[parent] += self.__tree[i]
+        self.__length = sum(len(block) for block in self.__blocks)
+
+    def __add(self, block, delta):
+        self.__length += delta
+        i = block + 1
+        while i < len(self.__tree):
+            self.__tree[i] += delta
+            i += i & -i
+
+    def __locate(self, index):
+        """Returns the block holding a position and the offset of the position in that block"""
+
+        if index < 0:
+            index += self.__length
+        if not 0 <= index < self.__length:
+            raise IndexError("queue index out of range")
+
+        # Walks down the Fenwick tree to the last block whose preceding blocks hold at most index items
+        position = 0
+        step = 1 << (len(self.__tree) - 1).bit_length()
+        while step:
+            following = position + step
+            if following < len(self.__tree) and self.__tree[following] <= index:
+                position = following
+                index -= self.__tree[following]
+            step >>= 1
+        return position, index
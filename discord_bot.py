@@ -3,79 +3,225 @@ import os
 import discord
 import logging
 import json
+import time
+import metrics
 from dotenv import load_dotenv
 from discord.ext import commands
-from ytdl import YTDLSource
+from ytdl import YTDLSource, OpusSource, create_source, resolve_track, stream_url, playlist_tracks, \
+    remove_stale_locks, warm_up_extractors
+from prefetch import Prefetcher
+from queue_view import QueueRenderer, QueuePageView, format_duration
+from extraction import ExtractionScheduler, ExtractionQueueFull
 from data.InMemoryDb import InMemoryDb
-from ytdl import download_path
+from data.SqliteDb import SqliteDb
+from cache import AudioCache
+from metadata_cache import MetadataCache
+from inactivity import InactivityTimers
+from session import SessionRegistry
+from status_message import StatusMessages
+from gapless import GaplessSource
+from audio_transform import fade_seconds
+from bulk import parse_entries, attachment_text, resolve_in_order
+from background_io import BackgroundIO
+from loop_watchdog import LoopWatchdog, loop_lag_threshold
+from admission import AdmissionControl, AdmissionRejected
+from ytdl import download_path, cache_max_bytes, cache_eviction_policy, default_playback_mode, \
+    stream_cache_fill, metadata_cache_path, metadata_cache_ttl, metadata_cache_max_entries, max_playlist_size
 
 
 class Music(commands.Cog):
-    def __init__(self, bot, db):
+    def __init__(self, bot, db, cache, metadata_cache):
         self.bot = bot
         self.db = db
+        self.cache = cache
+        self.metadata_cache = metadata_cache
+        self.cache.is_pinned = self.db.is_track_referenced
+        self.db.set_release_callback(self.release_file)
+        self.scheduler = ExtractionScheduler(bot.loop)
+        self.prefetcher = Prefetcher(db, cache, self.scheduler)
+        self.queue_renderer = QueueRenderer(db, self.prefetcher)
+        self.sessions = SessionRegistry(default_playback_mode)
+        self.admission = AdmissionControl(self.sessions, db, self.prefetcher)
+        self.inactivity = InactivityTimers(bot.loop, self.disconnect_idle)
+        self.status = StatusMessages(bot.loop, self.render_status)
+        # Guilds whose next track is being opened ahead of time
+        self.preparing_next = set()
+        self.register_metrics()
+
+    async def cog_unload(self):
+        self.inactivity.cancel_all()
+        self.status.close_all()
+        self.scheduler.shutdown()
+        if self.cache.io is not None:
+            # Lets the queued deletions finish
+            self.cache.io.shutdown()
+        self.metadata_cache.close()
+        self.db.close()
 
     def log(self, log_level, message):
         self.bot.logger.log(log_level, message)
 
-    async def auto_disconnect(self, ctx):
-        inactivity_timer = 300
+    def render_status(self, guild_id, note):
+        lines = [f"*{note}*"] if note else []
+        now_playing = self.db.get_now_playing_with_guild_id(guild_id)
+        if now_playing is not None:
+            lines.append(f"***Now playing:*** {now_playing.title}\n<{now_playing.original_url}>")
+        else:
+            lines.append("Not playing anything.")
+        if self.db.is_there_item_in_queue_for_guild_id(guild_id):
+            lines.append(self.queue_renderer.render(guild_id, 1))
+        else:
+            lines.append("There are currently no songs in the queue!")
+        return "\n".join(lines)
+
+    def update_status(self, ctx, note=None):
+        """Queues an edit of the guild's status message, edits are coalesced so this can be called freely"""
+
+        self.status.update(ctx.guild.id, ctx, note)
+
+    def register_metrics(self):
+        metrics.register_gauge(
+            "musicbot_queue_depth", "Songs waiting in the queue of each guild the bot is connected in",
+            lambda: {vc.guild.id: self.db.queue_size(vc.guild.id) or 0 for vc in self.bot.voice_clients},
+            label="guild")
+        metrics.register_gauge("musicbot_voice_clients", "Connected voice clients", lambda: len(self.bot.voice_clients))
+        metrics.register_gauge("musicbot_extraction_pending", "Extraction jobs waiting for a worker",
+                               lambda: self.scheduler.pending)
+        metrics.register_gauge("musicbot_extraction_running", "Extraction jobs running on a worker",
+                               lambda: self.scheduler.running)
+        metrics.register_gauge("musicbot_cache_hit_ratio", "Share of audio cache lookups that found the file",
+                               lambda: self.cache.hits / max(self.cache.hits + self.cache.misses, 1))
+        if self.cache.io is not None:
+            metrics.register_gauge("musicbot_pending_deletes", "Files waiting to be deleted by the background io thread",
+                                   lambda: self.cache.io.pending_deletes)
+        metrics.register_gauge("musicbot_download_path_bytes", "Disk space used by the download directory",
+                               lambda: self.bot.loop.run_in_executor(None, metrics.directory_size, download_path))
+
+    async def disconnect_idle(self, guild_id, ctx):
+        """Run by the inactivity timers once a guild has gone the whole timeout without playing anything"""
+
         voice_client = ctx.voice_client
-        await asyncio.sleep(inactivity_timer)
         if (voice_client is not None and not voice_client.is_playing() and not voice_client.is_paused()
                 and voice_client.is_connected()):
-            self.log(logging.INFO, f"Disconnecting after {inactivity_timer} seconds of inactivity.")
-            asyncio.run_coroutine_threadsafe(self.leave(ctx), self.bot.loop)
-            asyncio.run_coroutine_threadsafe(ctx.send("Leaving due to inactivity."), self.bot.loop)
-
-    def delete_file(self, player):
-        if not self.db.player_in_any_queue(player) and not self.db.player_in_any_now_playing(player):
-            filename = f"{player.data['id']}.mp3"
-            filepath = os.path.join(download_path, filename)
-            try:
-                os.remove(filepath)
-                self.log(logging.INFO, f"Deleted file {filename}")
-            except Exception as e:
-                self.log(logging.ERROR, f"Error deleting file. Message: {e}")
+            self.log(logging.INFO, f"Disconnecting after {self.inactivity.timeout:.0f} seconds of inactivity.")
+            await self.leave(ctx)
+            await ctx.send("Leaving due to inactivity.")
 
-    def dequeue_song(self, index, guild_id):
-        player = self.db.pop_index_from_queue(index, guild_id)
-        self.delete_file(player)
-        return player
+    def from_audio_thread(self, function, *args):
+        """Runs function(*args) as a task on the event loop. For the voice client's callbacks, which run on the audio
+        thread. Failures are logged, run_coroutine_threadsafe would leave them in a future nobody looks at"""
 
-    def stop_guild(self, ctx):
-        players = self.db.get_queue_with_guild_id(ctx.guild.id)
-        players.append(self.db.get_now_playing_with_guild_id(ctx.guild.id))
+        self.bot.loop.call_soon_threadsafe(self.spawn, function, args)
 
-        self.db.clean_up_for_guild_id(ctx.guild.id)
-        ctx.voice_client.stop()
+    def spawn(self, function, args):
+        task = self.bot.loop.create_task(function(*args))
+        task.add_done_callback(self.log_task_failure)
 
-        for player in players:
-            self.delete_file(player)
+    def log_task_failure(self, task):
+        if not task.cancelled() and task.exception() is not None:
+            self.log(logging.ERROR, f"Error handling a playback event. Message: {task.exception()}")
 
-    def jump_to_song(self, ctx, position):
-        queue = self.db.get_queue_with_guild_id(ctx.guild.id)
-        players_removed = queue[:position - 1]
+    def queue_changed(self, guild_id):
+        """Called after a guild's queue is edited. Drops the next track opened for a gapless transition if the queue
+        no longer starts with it"""
 
-        jump_result = self.db.queue_jump(ctx.guild.id, position)
-        ctx.voice_client.stop()
+        self.prefetcher.schedule(guild_id)
+        session = self.sessions.get(guild_id)
+        if session is None or session.chain is None or session.chain.upcoming is None:
+            return
+        head = self.db.get_queue_slice(guild_id, 0, 1)
+        if not head or head[0].key != session.chain.upcoming.track.key:
+            session.chain.clear_next()
+
+    def is_now_playing(self, guild_id, track):
+        """Compared by key, dbs that aren't in memory hand back a new Track every time"""
+
+        now_playing = self.db.get_now_playing_with_guild_id(guild_id)
+        return now_playing is not None and now_playing.key == track.key
 
-        for player in players_removed:
-            self.delete_file(player)
+    def release_file(self, key):
+        """Called by the db when a track is no longer queued or playing in any guild. The file stays in the audio
+        cache until it is evicted"""
 
+        self.cache.release(key)
+        self.log(logging.INFO, f"Released file {key}")
+
+    def end_song(self, guild_id, voice_client):
+        """Ends the playing song, fading it out if its source can fade. Either way the voice client moves on as if the
+        song had finished"""
+
+        session = self.sessions.get(guild_id)
+        player = session.player if session is not None else None
+        if fade_seconds > 0 and hasattr(player, "fade_out") and voice_client.is_playing():
+            player.fade_out(fade_seconds)
+        else:
+            voice_client.stop()
+
+    def stop_guild(self, ctx):
+        self.db.clean_up_for_guild_id(ctx.guild.id)
+        self.queue_changed(ctx.guild.id)
+        self.end_song(ctx.guild.id, ctx.voice_client)
+
+    def jump_to_song(self, ctx, position):
+        jump_result = self.db.queue_jump(ctx.guild.id, position)
+        self.queue_changed(ctx.guild.id)
+        self.end_song(ctx.guild.id, ctx.voice_client)
         return jump_result
 
     def remove_guild_items(self, guild_id):
-        queue_players = self.db.get_queue_with_guild_id(guild_id)
-        now_playing_player = self.db.get_now_playing_with_guild_id(guild_id)
-
+        self.sessions.close(guild_id)
+        self.status.close(guild_id)
+        self.inactivity.cancel(guild_id)
         self.db.clean_up_for_guild_id(guild_id)
+        self.db.delete_session(guild_id)
 
-        if queue_players is not None:
-            for player in queue_players:
-                self.delete_file(player)
-        if now_playing_player is not None:
-            self.delete_file(now_playing_player)
+    def guild_on_this_process(self, guild_id):
+        """When sharded over several processes sharing one db, each process only handles its own shards' guilds"""
+
+        shard_ids = getattr(self.bot, "shard_ids", None)
+        if shard_ids is None:
+            return True
+        return (guild_id >> 22) % self.bot.shard_count in shard_ids
+
+    async def restore_sessions(self):
+        """Rejoins the voice channels the bot was playing in before a restart and carries on with their queues"""
+
+        for guild_id, (voice_channel_id, text_channel_id) in list(self.db.get_sessions().items()):
+            if not self.guild_on_this_process(guild_id):
+                continue
+
+            guild = self.bot.get_guild(guild_id)
+            voice_channel = guild.get_channel(voice_channel_id) if guild is not None else None
+            text_channel = guild.get_channel(text_channel_id) if guild is not None else None
+            if voice_channel is None or text_channel is None or len(voice_channel.members) == 0:
+                self.log(logging.INFO, f"Not restoring the session for guild {guild_id}")
+                self.remove_guild_items(guild_id)
+                continue
+
+            # The song that was playing starts again from the beginning
+            now_playing = self.db.get_now_playing_with_guild_id(guild_id)
+            if now_playing is not None:
+                self.db.set_queue(guild_id, [now_playing] + list(self.db.get_queue_with_guild_id(guild_id) or []))
+                self.db.delete_now_playing(guild_id)
+
+            if not self.db.is_there_item_in_queue_for_guild_id(guild_id):
+                self.remove_guild_items(guild_id)
+                continue
+
+            self.log(logging.INFO, f"Restoring the session for guild {guild_id}")
+            try:
+                voice_client = await voice_channel.connect()
+                await guild.change_voice_state(channel=voice_channel, self_mute=False, self_deaf=True)
+            except Exception as e:
+                self.log(logging.ERROR, f"Error rejoining the voice channel. Message: {e}")
+                self.remove_guild_items(guild_id)
+                continue
+
+            self.sessions.open(guild_id, voice_client)
+            ctx = RestoredContext(guild, text_channel)
+            await ctx.send("Back after a restart, carrying on with the queue.")
+            self.queue_changed(guild_id)
+            self.bot.loop.create_task(self.play_song(ctx, guild_id, voice_client))
 
     @commands.command()
     async def join(self, ctx):
@@ -87,12 +233,25 @@ class Music(commands.Cog):
             return await ctx.send("{} is not connected to a voice channel".format(ctx.message.author.name))
 
         voice_channel = ctx.author.voice.channel
-        if ctx.voice_client is None:
-            await voice_channel.connect()
-        else:
-            await ctx.voice_client.move_to(voice_channel)
-        await ctx.guild.change_voice_state(channel=voice_channel, self_mute=False, self_deaf=True)
-        asyncio.run_coroutine_threadsafe(self.auto_disconnect(ctx), self.bot.loop)
+        connecting = ctx.voice_client is None
+        if connecting:
+            try:
+                self.admission.reserve_session(ctx.guild.id)
+            except AdmissionRejected as e:
+                self.log(logging.WARNING, f"Rejected joining a voice channel. Message: {e}")
+                return await ctx.send(str(e))
+        try:
+            if connecting:
+                await voice_channel.connect()
+            else:
+                await ctx.voice_client.move_to(voice_channel)
+            await ctx.guild.change_voice_state(channel=voice_channel, self_mute=False, self_deaf=True)
+            self.sessions.open(ctx.guild.id, ctx.voice_client)
+        finally:
+            if connecting:
+                self.admission.release_session(ctx.guild.id)
+        self.db.set_session(ctx.guild.id, voice_channel.id, ctx.channel.id)
+        self.inactivity.reset(ctx.guild.id, ctx)
 
     @commands.command()
     async def leave(self, ctx):
@@ -100,7 +259,7 @@ class Music(commands.Cog):
 
         self.log(logging.INFO, f"Leaving the voice channel.")
 
-        voice_client = ctx.message.guild.voice_client
+        voice_client = ctx.guild.voice_client
         if voice_client is not None and voice_client.is_connected():
             await voice_client.disconnect()
             await ctx.send("Disconnected from the voice channel.")
@@ -111,46 +270,292 @@ class Music(commands.Cog):
 
     @commands.command()
     async def play(self, ctx, *, url):
-        """Downloads and then plays"""
+        """Queues a song and plays it once it is downloaded"""
 
         self.log(logging.INFO, f"Play a song.")
 
+        requested_at = time.perf_counter()
         if ctx.voice_client.is_paused():
             ctx.voice_client.resume()
 
         guild_id = ctx.guild.id
-        await ctx.send(f'***Searching for song:*** {url}')
+        try:
+            self.admission.admit_queue(guild_id)
+            async with ctx.typing():
+                track = await resolve_track(url, scheduler=self.scheduler, guild_id=guild_id, cache=self.cache,
+                                            metadata_cache=self.metadata_cache)
+            self.admission.admit_track(track)
+            self.admission.admit_download(track)
+        except ExtractionQueueFull as e:
+            self.log(logging.WARNING, f"Rejected a song, the extraction queue is full. Message: {e}")
+            return await ctx.send("Too many songs are being looked up right now, try again in a moment!")
+        except AdmissionRejected as e:
+            self.log(logging.WARNING, f"Rejected a song. Message: {e}")
+            return await ctx.send(str(e))
+
+        self.db.add_to_queue(guild_id, track)
+        self.queue_changed(guild_id)
+        if ctx.voice_client.is_playing() or self.db.guild_id_in_now_playings(guild_id):
+            self.update_status(ctx, f"Added {track.title} to the queue.")
+        else:
+            voice_client = ctx.voice_client
+            await self.play_song(ctx, guild_id, voice_client, requested_at=requested_at)
 
-        async with ctx.typing():
-            player = await YTDLSource.from_url(url, loop=self.bot.loop)
+    @commands.command()
+    async def playlist(self, ctx, *, url):
+        """Queues the songs of a playlist, each song is downloaded once it gets close to playing"""
 
-        self.db.add_to_queue(guild_id, player)
-        if ctx.voice_client.is_playing():
-            await ctx.send(
-                f'Added song ***{player.title}*** to queue.\n'
-                f'*Number of items in queue*: {self.db.queue_size(guild_id)}'
-            )
-            return await self.queue(ctx)
+        self.log(logging.INFO, f"Queue a playlist.")
 
-        else:
-            voice_client = ctx.voice_client
-            await self.play_song(ctx, guild_id, voice_client)
+        requested_at = time.perf_counter()
+        guild_id = ctx.guild.id
+        space = self.admission.queue_space(guild_id)
+        if space == 0:
+            return await ctx.send(f"The queue is full, at most {self.admission.queue_length} songs can be queued!")
+        limit = max_playlist_size if space is None else min(max_playlist_size, space)
+
+        added = 0
+        too_long = 0
+        try:
+            async for tracks in playlist_tracks(url, scheduler=self.scheduler, guild_id=guild_id, cache=self.cache,
+                                                limit=limit):
+                for track in tracks:
+                    try:
+                        self.admission.admit_track(track)
+                    except AdmissionRejected:
+                        too_long += 1
+                        continue
+                    self.db.add_to_queue(guild_id, track)
+                    added += 1
+                self.queue_changed(guild_id)
+
+                voice_client = ctx.voice_client
+                if (voice_client is not None and not voice_client.is_playing()
+                        and not self.db.guild_id_in_now_playings(guild_id)
+                        and self.db.is_there_item_in_queue_for_guild_id(guild_id)):
+                    # Start playing the first batch while the rest of the playlist is still being listed
+                    track = self.db.advance_queue(guild_id)
+                    self.queue_changed(guild_id)
+                    self.bot.loop.create_task(self.start_track(ctx, guild_id, voice_client, track,
+                                                              requested_at=requested_at))
+
+                self.update_status(ctx, f"Loading the playlist, added {added} songs so far...")
+        except ExtractionQueueFull as e:
+            self.log(logging.WARNING, f"Rejected a playlist, the extraction queue is full. Message: {e}")
+            return await ctx.send("Too many songs are being looked up right now, try again in a moment!")
+        except Exception as e:
+            self.log(logging.ERROR, f"Error loading the playlist. Message: {e}")
+            return await ctx.send(f"Failed to load the rest of the playlist after adding {added} songs.")
+
+        if added == 0 and too_long == 0:
+            return await ctx.send(f'No songs were found in the playlist: {url}')
+
+        summary = f"Added {added} songs from the playlist to the queue."
+        if too_long:
+            summary += f" Left out {too_long} songs longer than {format_duration(self.admission.track_duration)}."
+        self.update_status(ctx, summary)
 
-    async def play_song(self, ctx, guild_id, voice_client):
-        queue = self.db.get_queue_with_guild_id(guild_id)
-        player = queue.pop(0)
-        self.db.set_queue(guild_id, queue)
+    @commands.command()
+    async def play_many(self, ctx, *, urls: str = ""):
+        """Queues several songs at once, one url or search query per line or from an attached text file"""
 
-        self.db.set_now_playing(guild_id, player)
+        self.log(logging.INFO, f"Queue several songs.")
 
-        self.log(logging.INFO, f"Playing the song.")
+        requested_at = time.perf_counter()
+        guild_id = ctx.guild.id
+        text = urls
+        for attachment in ctx.message.attachments:
+            attached = await attachment_text(attachment)
+            if attached is not None:
+                text += "\n" + attached
+
+        entries = parse_entries(text)
+        if not entries:
+            return await ctx.send("Give one url or search query per line, or attach a text file with them!")
+        space = self.admission.queue_space(guild_id)
+        if space == 0:
+            return await ctx.send(f"The queue is full, at most {self.admission.queue_length} songs can be queued!")
+        limit = max_playlist_size if space is None else min(max_playlist_size, space)
+        skipped = max(len(entries) - limit, 0)
+        entries = entries[:limit]
+
+        async def resolve(entry):
+            track = await resolve_track(entry, scheduler=self.scheduler, guild_id=guild_id, cache=self.cache,
+                                        metadata_cache=self.metadata_cache)
+            self.admission.admit_track(track)
+            return track
+
+        added = 0
+        failed = []
+        async with ctx.typing():
+            async for entry, track, error in resolve_in_order(entries, resolve):
+                if error is not None:
+                    self.log(logging.WARNING, f"Failed to resolve {entry}. Message: {error}")
+                    failed.append(entry)
+                    continue
+                self.db.add_to_queue(guild_id, track)
+                added += 1
+                self.queue_changed(guild_id)
+
+                voice_client = ctx.voice_client
+                if (voice_client is not None and not voice_client.is_playing()
+                        and not self.db.guild_id_in_now_playings(guild_id)):
+                    # Start playing the first song while the rest are still being looked up
+                    track = self.db.advance_queue(guild_id)
+                    self.queue_changed(guild_id)
+                    self.bot.loop.create_task(self.start_track(ctx, guild_id, voice_client, track,
+                                                              requested_at=requested_at))
+
+        summary = f"Added {added} of {len(entries)} songs to the queue."
+        if failed:
+            shown = ", ".join(failed[:5]) + (f" and {len(failed) - 5} more" if len(failed) > 5 else "")
+            summary += f" Couldn't queue: {shown}."
+        if skipped:
+            summary += f" Left out the last {skipped}, at most {limit} more songs can be queued."
+        self.update_status(ctx, summary)
+
+    def get_playback_mode(self, guild_id):
+        session = self.sessions.get(guild_id)
+        return session.playback_mode if session is not None else default_playback_mode
+
+    async def play_song(self, ctx, guild_id, voice_client, requested_at=None):
+        track = self.db.advance_queue(guild_id)
+        self.queue_changed(guild_id)
+        await self.start_track(ctx, guild_id, voice_client, track, requested_at=requested_at)
+
+    async def fetch_audio(self, guild_id, track, allow_stream=True):
+        """Gets a track ready to be opened. Returns the media url to stream it from, or None once it is downloaded"""
+
+        if not allow_stream or self.get_playback_mode(guild_id) != "stream" or self.prefetcher.is_ready(track):
+            await self.prefetcher.ensure_ready(track, guild_id)
+            return None
+
+        media_url = await stream_url(track.original_url, scheduler=self.scheduler, guild_id=guild_id)
+        if stream_cache_fill:
+            # Fill the cache in the background so the track is played from disk next time
+            self.prefetcher.prefetch(track, guild_id)
+        return media_url
+
+    @staticmethod
+    def open_source(track, media_url, position=0):
+        with metrics.ffmpeg_spawn_seconds.time():
+            if media_url is not None:
+                return YTDLSource.from_stream(track, media_url, position=position)
+            return create_source(track, position=position)
+
+    async def start_track(self, ctx, guild_id, voice_client, track, position=0, allow_stream=True, requested_at=None):
+        """Streams the track or plays it from disk, waiting for the download if it isn't ready yet. requested_at is
+        when the play command that started the track was run, for the play to audio metric"""
+
+        try:
+            async with ctx.typing():
+                media_url = await self.fetch_audio(guild_id, track, allow_stream)
+        except Exception as e:
+            self.log(logging.ERROR, f"Error getting the song. Message: {e}")
+            await ctx.send(f"Failed to get ***{track.title}***, skipping it.")
+            return await self.play_next(ctx)
+
+        # The guild might have been stopped or disconnected while the download was finishing
+        session = self.sessions.get(guild_id)
+        if (session is None or not self.is_now_playing(guild_id, track) or voice_client is None
+                or not voice_client.is_connected()):
+            return
+
+        # Starting ffmpeg forks the bot process, which takes long enough to hold up the event loop
+        player = await self.bot.loop.run_in_executor(None, self.open_source, track, media_url, position)
+        if (self.sessions.get(guild_id) is not session or not self.is_now_playing(guild_id, track)
+                or not voice_client.is_connected()):
+            return player.cleanup()
+        player.requested_at = requested_at
 
-        voice_client.play(player,
-                          after=lambda e: asyncio.run_coroutine_threadsafe(self.play_next(ctx), self.bot.loop))
-        asyncio.run_coroutine_threadsafe(ctx.send(
-            f'***Now playing:*** {player.title}\n'
-            f'{player.data["original_url"]}'
-        ), self.bot.loop)
+        self.log(logging.INFO, f"Playing the song.")
+        self.inactivity.cancel(guild_id)
+
+        # The chain lets the next song start in the audio thread the moment this one ends
+        chain = GaplessSource(
+            player,
+            on_prepare=lambda c: self.from_audio_thread(self.prepare_next, guild_id, c),
+            on_advance=lambda c, previous, current: self.from_audio_thread(self.track_advanced, ctx, guild_id, c,
+                                                                           current))
+        session.player = player
+        session.chain = chain
+        voice_client.play(chain,
+                          after=lambda e: self.from_audio_thread(self.track_finished, ctx, guild_id, chain.current, e))
+        if position == 0:
+            self.update_status(ctx)
+
+    async def prepare_next(self, guild_id, chain):
+        """Opens the first queued song while the current one is finishing and hands it to the chain"""
+
+        session = self.sessions.get(guild_id)
+        if session is None or session.chain is not chain or guild_id in self.preparing_next:
+            return
+        head = self.db.get_queue_slice(guild_id, 0, 1)
+        if not head:
+            return
+
+        track = head[0]
+        self.preparing_next.add(guild_id)
+        try:
+            media_url = await self.fetch_audio(guild_id, track)
+            player = await self.bot.loop.run_in_executor(None, self.open_source, track, media_url)
+            # Reading the first frame makes sure ffmpeg is up and decoding before the switch
+            first_frame = await self.bot.loop.run_in_executor(None, player.read)
+        except Exception as e:
+            # The song is opened the usual way once the current one ends
+            self.log(logging.WARNING, f"Error opening the next song ahead of time. Message: {e}")
+            return
+        finally:
+            self.preparing_next.discard(guild_id)
+
+        if self.sessions.get(guild_id) is not session or session.chain is not chain or not first_frame:
+            return player.cleanup()
+        head = self.db.get_queue_slice(guild_id, 0, 1)
+        if not head or head[0].key != track.key:
+            # The front of the queue changed while the song was being opened. Songs added behind it don't matter
+            player.cleanup()
+            return await self.prepare_next(guild_id, chain)
+        if not chain.set_next(player, first_frame):
+            player.cleanup()
+
+    async def track_advanced(self, ctx, guild_id, chain, player):
+        """Catches the db up after the audio thread switched to the song prepared by prepare_next"""
+
+        session = self.sessions.get(guild_id)
+        if session is None or session.chain is not chain:
+            return
+
+        self.log(logging.INFO, f"Playing the next song without a gap.")
+        track = self.db.advance_queue(guild_id)
+        if track is not None and track.key == player.track.key:
+            # Keeps the now playing entry identical to the queued one
+            player.track = track
+            session.player = player
+            self.queue_changed(guild_id)
+            return self.update_status(ctx)
+
+        # The queue changed too late to drop the prepared song, play the one that is actually next instead
+        session.player = session.chain = None
+        session.voice_client.stop()
+        if track is not None:
+            return await self.start_track(ctx, guild_id, session.voice_client, track)
+        self.db.delete_now_playing(guild_id)
+        self.inactivity.reset(guild_id, ctx)
+        self.update_status(ctx)
+
+    async def track_finished(self, ctx, guild_id, player, error):
+        # Nothing to carry on with if the bot left the guild or another source took over while this one was ending
+        session = self.sessions.get(guild_id)
+        if session is None or session.player is not player:
+            return
+        session.player = session.chain = None
+
+        if player.stream_failed(error):
+            self.log(logging.WARNING, f"Stream failed at {player.elapsed:.0f}s, falling back to the downloaded file. "
+                                      f"Message: {error}")
+            return await self.start_track(ctx, guild_id, session.voice_client, player.track,
+                                          position=player.elapsed, allow_stream=False)
+        await self.play_next(ctx)
 
     async def play_next(self, ctx):
         self.log(logging.INFO, f"Attempting to play the next song.")
@@ -158,14 +563,13 @@ class Music(commands.Cog):
         guild_id = ctx.guild.id
         voice_client = ctx.voice_client
 
-        previous_now_playing_player = self.db.get_now_playing_with_guild_id(guild_id)
         self.db.delete_now_playing(guild_id)
-        self.delete_file(previous_now_playing_player)
 
         if self.db.is_there_item_in_queue_for_guild_id(guild_id):
             await self.play_song(ctx, guild_id, voice_client)
         else:
-            await self.auto_disconnect(ctx)
+            self.inactivity.reset(guild_id, ctx)
+            self.update_status(ctx)
 
     @commands.command()
     async def now_playing(self, ctx):
@@ -181,7 +585,7 @@ class Music(commands.Cog):
 
         await ctx.send(
             f'***Current Song:*** {np.title}\n'
-            f'{np.data["original_url"]}'
+            f'{np.original_url}'
         )
 
         self.log(logging.INFO, f"Showing the current song.")
@@ -228,29 +632,25 @@ class Music(commands.Cog):
             await ctx.send("This is the last song in the queue!")
 
         self.log(logging.INFO, f"Skipping the current song.")
-        ctx.voice_client.stop()
-        # Stopping the voice client automatically plays the next song because this goes back to the play_next function
-        # The play_next function will also delete the currently playing file
+        self.end_song(ctx.guild.id, ctx.voice_client)
+        # Ending the song automatically plays the next one because this goes back to the play_next function
+        # The song's file stays in the audio cache until it is evicted
 
     @commands.command()
-    async def queue(self, ctx):
+    async def queue(self, ctx, page: int = 1):
         """Shows current queue"""
 
         self.log(logging.INFO, f"Showing items in queue.")
 
-        if not self.db.is_there_item_in_queue_for_guild_id(ctx.guild.id):
+        guild_id = ctx.guild.id
+        if not self.db.is_there_item_in_queue_for_guild_id(guild_id):
             return await ctx.send("There are currently no songs in the queue!")
         else:
-            song_list = ""
-            num = 1
-            for player in self.db.get_queue_with_guild_id(ctx.guild.id):
-                song_list += f"> **{num}.** {player.title}\n"
-                num += 1
-
-            return await ctx.send(
-                f"Number of songs in queue: {self.db.queue_size(ctx.guild.id)}\n"
-                f"{song_list}"
-            )
+            page = min(max(page, 1), self.queue_renderer.page_count(guild_id))
+            content = self.queue_renderer.render(guild_id, page)
+            if self.queue_renderer.page_count(guild_id) == 1:
+                return await ctx.send(content)
+            return await ctx.send(content, view=QueuePageView(self.queue_renderer, guild_id, page))
 
     @commands.command()
     async def dequeue(self, ctx, *, index: int):
@@ -264,16 +664,15 @@ class Music(commands.Cog):
         if not self.db.is_there_item_in_queue_for_guild_id(guild_id):
             return await ctx.send("There are currently no songs in the queue!")
         elif not self.db.is_index_valid(index, guild_id):
-            await ctx.send(f"The values have to be within the range of *1 - {self.db.queue_size(guild_id)}!*")
-            return await self.queue(ctx)
+            return await ctx.send(f"The values have to be within the range of *1 - {self.db.queue_size(guild_id)}!*")
 
-        player = self.dequeue_song(index, guild_id)
-        if player is None:
+        track = self.db.pop_index_from_queue(index, guild_id)
+        if track is None:
             return await ctx.send(f"Error popping index from queue.")
+        self.queue_changed(guild_id)
 
-        await ctx.send(f"Removed the song from queue: {player.title}")
-        self.log(logging.INFO, f"Removed the song from queue: {player.title}")
-        return await self.queue(ctx)
+        self.log(logging.INFO, f"Removed the song from queue: {track.title}")
+        self.update_status(ctx, f"Removed the song from queue: {track.title}")
 
     @commands.command()
     async def queue_swap(self, ctx, first: int, second: int):
@@ -286,21 +685,17 @@ class Music(commands.Cog):
         queue_length = self.db.queue_size(guild_id)
 
         if not self.db.is_index_valid(first, guild_id) or not self.db.is_index_valid(second, guild_id):
-            await ctx.send(f"The values have to be within the range of *1 - {queue_length}!*")
-            return await self.queue(ctx)
-
-        await ctx.send(f"Swapping the songs in position *{first}* and *{second}* of the queue.")
+            return await ctx.send(f"The values have to be within the range of *1 - {queue_length}!*")
 
         swap_result = self.db.queue_swap(guild_id, first, second)
+        self.queue_changed(guild_id)
 
         if swap_result:
-            await ctx.send(f"Swapped the songs in position *{first}* and *{second}* of the queue.")
             self.log(logging.INFO, f"Swapped the songs in position *{first}* and *{second}* of the queue.")
+            self.update_status(ctx, f"Swapped the songs in position {first} and {second} of the queue.")
         else:
             await ctx.send(f"Failed swapping songs in position *{first}* and *{second}* of the queue.")
 
-        await self.queue(ctx)
-
     @commands.command()
     async def queue_jump(self, ctx, position: int):
         """Jumps to a position in the queue, skipping everything in between"""
@@ -311,18 +706,16 @@ class Music(commands.Cog):
 
         original_queue_length = self.db.queue_size(guild_id)
         if not self.db.is_index_valid(position, guild_id):
-            await ctx.send(f"The values have to be within the range of *1 - {original_queue_length}!*")
-            return await self.queue(ctx)
+            return await ctx.send(f"The values have to be within the range of *1 - {original_queue_length}!*")
 
         jump_result = self.jump_to_song(ctx, position)
         if jump_result:
-            await ctx.send(f"Jumping to the song in position *{position}* of the queue.")
+            self.update_status(ctx, f"Jumped to the song in position {position} of the queue.")
             self.log(logging.INFO, "Jumped to the song in position *{position}* of the queue.")
             # Stopping the voice client automatically plays the next song because this goes
             # back to the play_next function
         else:
             await ctx.send(f"Failed to jump to position *{position}* of the queue.")
-        return await self.queue(ctx)
 
     @commands.command()
     async def queue_move(self, ctx, index_from: int, index_to: int):
@@ -339,16 +732,60 @@ class Music(commands.Cog):
         elif index_from == index_to:
             return await ctx.send(f"The song is already in that position!")
 
-        await ctx.send(f"Moving the song in position {index_from} to {index_to} of the queue.")
-
         move_result = self.db.queue_move(guild_id, index_from, index_to)
+        self.queue_changed(guild_id)
         if move_result:
             self.log(logging.INFO, "Moved the song in position {index_from} to {index_to} of the queue.")
-            await ctx.send(f"Moved the song in position {index_from} to {index_to} of the queue.")
+            self.update_status(ctx, f"Moved the song in position {index_from} to {index_to} of the queue.")
         else:
             await ctx.send(f"Failed to move the song in position {index_from} to {index_to} of the queue.")
 
-        return await self.queue(ctx)
+    @commands.command()
+    async def queue_remove(self, ctx, start: int, end: int):
+        """Removes every song from one position of the queue to another"""
+
+        guild_id = ctx.guild.id
+        if not self.db.is_there_item_in_queue_for_guild_id(guild_id):
+            return await ctx.send("There are currently no songs in the queue!")
+
+        queue_length = self.db.queue_size(guild_id)
+        if not self.db.is_index_valid(start, guild_id) or not self.db.is_index_valid(end, guild_id):
+            return await ctx.send(f"The values have to be within the range of *1 - {queue_length}!*")
+        elif start > end:
+            return await ctx.send(f"The start position has to come before the end position!")
+
+        removed = self.db.queue_remove_range(guild_id, start, end)
+        if removed is None:
+            return await ctx.send(f"Failed to remove the songs in positions *{start}* to *{end}* of the queue.")
+
+        self.queue_changed(guild_id)
+        self.log(logging.INFO, f"Removed {len(removed)} songs from the queue.")
+        self.update_status(ctx, f"Removed {len(removed)} songs from the queue.")
+
+    @commands.command()
+    async def shuffle(self, ctx):
+        """Shuffles the queue"""
+
+        guild_id = ctx.guild.id
+        if not self.db.queue_shuffle(guild_id):
+            return await ctx.send("There are currently no songs in the queue!")
+
+        self.queue_changed(guild_id)
+        self.log(logging.INFO, "Shuffled the queue.")
+        self.update_status(ctx, "Shuffled the queue.")
+
+    @commands.command()
+    async def dedupe(self, ctx):
+        """Removes songs that are already earlier in the queue"""
+
+        guild_id = ctx.guild.id
+        if not self.db.is_there_item_in_queue_for_guild_id(guild_id):
+            return await ctx.send("There are currently no songs in the queue!")
+
+        removed = self.db.queue_dedupe(guild_id)
+        self.queue_changed(guild_id)
+        self.log(logging.INFO, f"Removed {len(removed)} repeated songs from the queue.")
+        self.update_status(ctx, f"Removed {len(removed)} repeated songs from the queue.")
 
     @commands.command()
     async def volume(self, ctx, *, volume: int = None):
@@ -358,20 +795,55 @@ class Music(commands.Cog):
             return await ctx.send("The volume provided was not an int.")
         elif ctx.voice_client is None:
             return await ctx.send("Not connected to a voice channel!")
-        elif volume is None:
+
+        session = self.sessions.get(ctx.guild.id)
+        player = session.player if session is not None else None
+        if volume is None:
             self.log(logging.INFO, "Showing current volume.")
-            return await ctx.send(f'***Current Volume:*** {ctx.voice_client.source.volume*100}%')
+            if player is None:
+                return await ctx.send("Not currently playing a song!")
+            return await ctx.send(f'***Current Volume:*** {player.volume*100}%')
 
         if volume < 0:
             return await ctx.send(f'Volume *{volume}*% is too low!')
         elif volume > 150:
             return await ctx.send(f'Volume *{volume}*% is too high!')
 
-        if ctx.voice_client.source is not None:
+        if player is not None:
             self.log(logging.INFO, "Changing the volume")
-            ctx.voice_client.source.volume = volume / 100
+            if isinstance(player, OpusSource):
+                # Passthrough sources can't scale audio, so ffmpeg is restarted at the new volume, off the loop
+                replacement = await self.bot.loop.run_in_executor(None, player.with_volume, volume / 100)
+                if self.sessions.get(ctx.guild.id) is not session or session.player is not player:
+                    # The song ended while ffmpeg was starting
+                    replacement.cleanup()
+                    return await ctx.send("Not currently playing a song!")
+                session.player = replacement
+                session.chain.replace_current(replacement)
+            else:
+                player.volume = volume / 100
             await ctx.send(f"Changed volume to {volume}%")
 
+    @commands.command()
+    async def playback_mode(self, ctx, *, mode: str = None):
+        """Shows or sets whether songs are streamed or downloaded before playing"""
+
+        guild_id = ctx.guild.id
+        if mode is None:
+            return await ctx.send(f"***Playback mode:*** {self.get_playback_mode(guild_id)}")
+
+        mode = mode.lower()
+        if mode not in ("stream", "download"):
+            return await ctx.send("The playback mode has to be either *stream* or *download*!")
+
+        session = self.sessions.get(guild_id)
+        if session is None:
+            return await ctx.send("Not connected to a voice channel!")
+
+        session.playback_mode = mode
+        self.log(logging.INFO, f"Changing the playback mode to {mode}.")
+        await ctx.send(f"Changed the playback mode to {mode}. This applies from the next song.")
+
     @commands.command()
     async def stop(self, ctx):
         """Stops the current song and clears the queue"""
@@ -384,10 +856,10 @@ class Music(commands.Cog):
             await ctx.send(f"Not connected to a voice channel!")
 
         self.stop_guild(ctx)
+        self.update_status(ctx, "Song has been stopped and queue has been cleared.")
 
-        await ctx.send(f"Song has been stopped and queue has been cleared.")
-        return await self.queue(ctx)
-
+    @play_many.before_invoke
+    @playlist.before_invoke
     @play.before_invoke
     async def ensure_voice(self, ctx):
         """Makes sure that the user is connected to a voice channel before a play command is executed"""
@@ -397,19 +869,81 @@ class Music(commands.Cog):
         if ctx.voice_client is None:
             if ctx.author.voice:
                 await self.join(ctx)
+                if ctx.voice_client is None:
+                    raise commands.CommandError("Not admitted to a voice channel!")
             else:
                 await ctx.send("You are not connected to a voice channel!")
                 raise commands.CommandError("Author not connected to a voice channel!")
+        elif ctx.guild.id not in self.sessions:
+            self.sessions.open(ctx.guild.id, ctx.voice_client)
+
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member, before, after):
+        if member.id == self.bot.user.id:
+            if after.channel is None:
+                # Disconnected, by a command or by someone else
+                if member.guild.id in self.sessions:
+                    self.log(logging.INFO, f"Cleaning up the queue and the now playing values")
+                    self.remove_guild_items(member.guild.id)
+            elif before.channel != after.channel:
+                self.sessions.move(member.guild.id, after.channel.id)
+            return
+
+        if before.channel is None or before.channel == after.channel:
+            return
+        session = self.sessions.by_channel(before.channel.id)
+        if session is None:
+            return
+
+        # Everyone else left the bot's channel
+        if len(before.channel.members) == 1:
+            voice_client = session.voice_client
+            if voice_client.is_playing():
+                voice_client.stop()
+
+            self.log(logging.INFO, f"Cleaning up the queue and the now playing values")
+            self.remove_guild_items(session.guild_id)
+            return await voice_client.disconnect()
+
+
+class RestoredContext:
+    """Stands in for a command context when a session is resumed after a restart and there is no message to reply
+    to"""
+
+    def __init__(self, guild, channel):
+        self.guild = guild
+        self.channel = channel
+
+    @property
+    def voice_client(self):
+        return self.guild.voice_client
+
+    async def send(self, *args, **kwargs):
+        return await self.channel.send(*args, **kwargs)
+
+    def typing(self):
+        return self.channel.typing()
 
 
 intents = discord.Intents.default()
 intents.message_content = True
 
-bot = commands.Bot(
-    command_prefix=commands.when_mentioned_or("^"),
-    description='Relatively simple music bot example',
-    intents=intents,
-)
+if os.getenv("shard_count") is not None:
+    # Run by main.py's sharded mode, each process gets a range of the shards
+    shard_ids = os.getenv("shard_ids")
+    bot = commands.AutoShardedBot(
+        command_prefix=commands.when_mentioned_or("^"),
+        description='Relatively simple music bot example',
+        intents=intents,
+        shard_count=int(os.getenv("shard_count")),
+        shard_ids=[int(shard_id) for shard_id in shard_ids.split(",")] if shard_ids else None,
+    )
+else:
+    bot = commands.Bot(
+        command_prefix=commands.when_mentioned_or("^"),
+        description='Relatively simple music bot example',
+        intents=intents,
+    )
 
 
 @bot.event
@@ -421,51 +955,10 @@ async def on_guild_join(guild):
 async def on_ready():
     bot.logger.log(logging.INFO, f'[start] Logged in as {bot.user} (ID: {bot.user.id})')
 
-
-@bot.event
-async def on_voice_state_update(member, before, after):
-    channel_before = before.channel
-    channel_after = after.channel
-
-    if len(bot.voice_clients) == 0:
-        return
-
-    if channel_before is not None and (channel_after is None or channel_before != channel_after):
-        if len(before.channel.members) == 1 and bot_in_voice_channel(channel_before):
-            voice_client = get_voice_client(channel_before)
-
-            if voice_client.is_playing():
-                voice_client.stop()
-
-            if bot.get_cog("Music").db.guild_id_in_queues(voice_client.guild.id):
-                bot.get_cog("Music").log(logging.INFO, f"Cleaning up the queue and the now playing values")
-                bot.get_cog("Music").remove_guild_items(voice_client.guild.id)
-            return await voice_client.disconnect()
-    elif bot.application_id == member.id and (channel_before is not None and channel_after is None):
-        voice_client = get_voice_client(channel_before)
-        bot.get_cog("Music").log(logging.INFO, f"Cleaning up the queue and the now playing values")
-        bot.get_cog("Music").remove_guild_items(voice_client.guild.id)
-        return
-    else:
-        return
-
-
-def bot_in_voice_channel(channel) -> bool:
-    """Checks if the bot is in the matching channel"""
-
-    for voice_client in bot.voice_clients:
-        if voice_client.channel == channel:
-            return True
-    return False
-
-
-def get_voice_client(channel):
-    """Gets the matching voice client, does not check if channel exists. Returns None if no channels are found"""
-
-    for voice_client in bot.voice_clients:
-        if voice_client.channel == channel:
-            return voice_client
-    return None
+    # on_ready also fires after reconnects, sessions are only restored once
+    if not getattr(bot, "sessions_restored", False):
+        bot.sessions_restored = True
+        await bot.get_cog("Music").restore_sessions()
 
 
 async def main():
@@ -485,6 +978,24 @@ async def main():
         logger = logging.getLogger()
 
         bot.logger = logger
-        db = InMemoryDb()
-        await bot.add_cog(Music(bot, db))
+        db_backend = os.getenv("db_backend", "memory")
+        if db_backend == "sqlite":
+            db = SqliteDb(os.getenv("db_path", "musicbot.sqlite3"))
+        elif db_backend == "redis":
+            # Only needed for this backend, so redis isn't a hard requirement
+            from data.RedisDb import RedisDb
+            db = RedisDb(os.getenv("redis_url", "redis://localhost:6379/0"))
+        else:
+            db = InMemoryDb()
+        cache = AudioCache(download_path, cache_max_bytes, policy=cache_eviction_policy,
+                           is_pinned=db.is_track_referenced, io=BackgroundIO())
+        cache.rebuild_index()
+        remove_stale_locks()
+        await asyncio.get_running_loop().run_in_executor(None, warm_up_extractors)
+        metadata_cache = MetadataCache(metadata_cache_path, metadata_cache_ttl, metadata_cache_max_entries)
+        await bot.add_cog(Music(bot, db, cache, metadata_cache))
+        if metrics.metrics_port is not None:
+            await metrics.start_server(metrics.metrics_port)
+        if loop_lag_threshold > 0:
+            LoopWatchdog(asyncio.get_running_loop()).start()
         await bot.start(discord_token)
@@ -0,0 +1,166 @@
+import asyncio
+import logging
+import os
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+extraction_backend = os.getenv("extraction_backend", "thread")
+extraction_workers = int(os.getenv("extraction_workers", "4"))
+extraction_max_pending = int(os.getenv("extraction_max_pending", "20"))
+extraction_jobs_per_worker = int(os.getenv("extraction_jobs_per_worker", "50"))
+extraction_timeout = float(os.getenv("extraction_timeout", "300"))
+
+
+class ExtractionQueueFull(Exception):
+    pass
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+class ThreadBackend:
+    """Runs extraction jobs on threads in the bot process"""
+
+    def __init__(self, loop, workers):
+        self.loop = loop
+        self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="extraction")
+
+    async def run(self, function, *args):
+        return await self.loop.run_in_executor(self.__executor, function, *args)
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ProcessBackend:
+    """Runs extraction jobs in worker processes so yt-dlp's parsing doesn't hold the bot process' GIL.
+
+    Workers are replaced after a number of jobs to keep memory in check. A job that runs past the timeout gets the
+    whole pool killed and restarted, and jobs that were lost because the pool broke are retried once.
+    """
+
+    def __init__(self, loop, workers, jobs_per_worker=extraction_jobs_per_worker, timeout=extraction_timeout):
+        self.loop = loop
+        self.workers = workers
+        self.jobs_per_worker = jobs_per_worker
+        self.timeout = timeout
+        self.__executor = self.__create_executor()
+
+    def __create_executor(self):
+        return ProcessPoolExecutor(max_workers=self.workers, max_tasks_per_child=self.jobs_per_worker)
+
+    async def run(self, function, *args):
+        for attempt in range(2):
+            executor = self.__executor
+            try:
+                return await asyncio.wait_for(self.loop.run_in_executor(executor, function, *args), self.timeout)
+            except asyncio.TimeoutError:
+                self.__restart(executor, "a job timed out")
+                raise ExtractionTimeout(f"Extraction took longer than {self.timeout} seconds")
+            except BrokenProcessPool:
+                self.__restart(executor, "a worker crashed")
+                if attempt > 0:
+                    raise
+
+    def __restart(self, executor, reason):
+        if executor is not self.__executor:
+            # Another job already restarted the pool
+            return
+
+        logging.getLogger().log(logging.WARNING, f"Restarting the extraction worker pool, {reason}")
+        self.__executor = self.__create_executor()
+        # ProcessPoolExecutor has no public way to kill workers that are stuck in a job
+        for process in list(executor._processes.values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        self.__executor.shutdown(wait=False, cancel_futures=True)
+
+
+def create_backend(loop, name=extraction_backend, workers=extraction_workers):
+    if name == "process":
+        return ProcessBackend(loop, workers)
+    return ThreadBackend(loop, workers)
+
+
+class ExtractionScheduler:
+    """Runs yt-dlp jobs on a bounded pool of workers.
+
+    Waiting jobs are queued per guild and the guilds take turns, so one guild queueing a lot of songs can't starve
+    the others. Jobs with the same key that are already waiting or running are shared instead of being run twice.
+    """
+
+    def __init__(self, loop, backend=None, workers=extraction_workers, max_pending=extraction_max_pending):
+        self.loop = loop
+        self.workers = workers
+        self.max_pending = max_pending
+        self.backend = backend or create_backend(loop, workers=workers)
+
+        self.__guild_jobs = OrderedDict()
+        self.__in_flight = {}
+        self.__pending = 0
+        self.__running = 0
+
+    @property
+    def pending(self):
+        return self.__pending
+
+    @property
+    def running(self):
+        return self.__running
+
+    def submit(self, guild_id, key, function, *args, limited=True):
+        """Queues a job and returns an awaitable for its result.
+
+        Raises ExtractionQueueFull if a limited job is submitted while too many jobs are already waiting. Jobs for
+        songs that are already queued aren't limited so they are never dropped.
+        """
+
+        future = self.__in_flight.get(key)
+        if future is None:
+            if limited and self.__pending >= self.max_pending:
+                raise ExtractionQueueFull(f"There are already {self.__pending} songs waiting to be looked up")
+
+            future = self.loop.create_future()
+            # Nobody might be left waiting on the result if every caller was cancelled
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            self.__in_flight[key] = future
+            self.__guild_jobs.setdefault(guild_id, deque()).append((key, function, args, future))
+            self.__pending += 1
+            self.__dispatch()
+
+        # Shielded so one caller being cancelled doesn't cancel the job for everyone else sharing it
+        return asyncio.shield(future)
+
+    def shutdown(self):
+        self.backend.shutdown()
+
+    def __dispatch(self):
+        while self.__running < self.workers and self.__guild_jobs:
+            guild_id, jobs = self.__guild_jobs.popitem(last=False)
+            key, function, args, future = jobs.popleft()
+            if jobs:
+                # Back of the line until every other guild with waiting jobs has had a turn
+                self.__guild_jobs[guild_id] = jobs
+
+            self.__pending -= 1
+            self.__running += 1
+            job = self.loop.create_task(self.backend.run(function, *args))
+            job.add_done_callback(lambda j, key=key, future=future: self.__finished(key, future, j))
+
+    def __finished(self, key, future, job):
+        self.__running -= 1
+        del self.__in_flight[key]
+
+        if not future.done():
+            if job.cancelled():
+                future.cancel()
+            elif job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+        self.__dispatch()
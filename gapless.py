@@ -0,0 +1,130 @@
+import os
+import threading
+import discord
+from audio_transform import mix
+
+
+# How long before the end of a track the next one is opened
+gapless_preload_seconds = float(os.getenv("gapless_preload_seconds", "5"))
+# Seconds the end of a song and the start of the next are faded across, 0 switches without a crossfade
+crossfade_seconds = float(os.getenv("crossfade_seconds", "0"))
+
+
+class GaplessSource(discord.AudioSource):
+    """Plays the sources of consecutive tracks through a single voice client player.
+
+    Once the current track is within preload seconds of its end, on_prepare(chain) is called from the audio thread
+    so the bot can open the next track's source and hand it over with set_next, along with its first frame. When the
+    current source runs out the audio thread switches to the next one straight away, in the same read, so no frame
+    waits on the event loop. on_advance(chain, previous, current) is then called from the audio thread to let the
+    bot catch up. Without a next source the chain ends like a single track would.
+
+    With a crossfade the next source starts fading in under the current one that many seconds before the current
+    one ends. Only sources that can fade (PCMTransformer) are crossfaded.
+    """
+
+    def __init__(self, current, on_prepare, on_advance, preload=gapless_preload_seconds, crossfade=crossfade_seconds):
+        self.current = current
+        self.on_prepare = on_prepare
+        self.on_advance = on_advance
+        self.crossfade = crossfade
+        # The next source has to be open before the crossfade starts
+        self.preload = max(preload, crossfade + 1) if crossfade else preload
+
+        self.__lock = threading.Lock()
+        self.__next = None
+        self.__next_frame = None
+        self.__prepare_requested = False
+        self.__mixing = False
+
+    @property
+    def upcoming(self):
+        return self.__next
+
+    def is_opus(self):
+        return self.current.is_opus()
+
+    def set_next(self, source, first_frame):
+        """Queues the source to switch to once the current one ends. Returns False if the source can't follow the
+        current one, the voice client can't switch between opus and pcm sources mid-stream"""
+
+        if source.is_opus() != self.current.is_opus():
+            return False
+        with self.__lock:
+            previous, self.__next, self.__next_frame = self.__next, source, first_frame
+        if previous is not None:
+            previous.cleanup()
+        return True
+
+    def clear_next(self):
+        """Drops the next source, e.g. because the queue changed. It is asked for again if the current track is
+        already close to its end"""
+
+        with self.__lock:
+            previous, self.__next, self.__next_frame = self.__next, None, None
+            self.__mixing = False
+        self.__prepare_requested = False
+        if previous is not None:
+            previous.cleanup()
+
+    def replace_current(self, source):
+        previous, self.current = self.current, source
+        previous.cleanup()
+
+    def read(self):
+        current = self.current
+        data = current.read()
+        if data:
+            if not self.__prepare_requested and self.__near_end(current, self.preload):
+                self.__prepare_requested = True
+                self.on_prepare(self)
+            if self.crossfade:
+                return self.__crossfade(current, data)
+            return data
+
+        if current is not self.current:
+            # Replaced while this read was running
+            return self.current.read()
+
+        with self.__lock:
+            if self.__next is None or current.stream_failed(None):
+                # A failed stream isn't skipped, it ends the chain so the bot can fall back to the downloaded file
+                return data
+            upcoming, frame = self.__next, self.__next_frame
+            self.__next = self.__next_frame = None
+            self.__mixing = False
+
+        self.current = upcoming
+        self.__prepare_requested = False
+        current.cleanup()
+        self.on_advance(self, current, upcoming)
+        # A crossfaded source already played its first frame
+        return frame if frame is not None else upcoming.read()
+
+    def __crossfade(self, current, data):
+        with self.__lock:
+            upcoming = self.__next
+            if upcoming is None:
+                return data
+            if not self.__mixing:
+                if (not self.__near_end(current, self.crossfade) or not hasattr(current, "fade_out")
+                        or not hasattr(upcoming, "fade_in")):
+                    return data
+                self.__mixing = True
+                # The first frame was read at full volume, it is dropped so the fade starts from silence
+                self.__next_frame = None
+                remaining = current.track.duration - current.elapsed
+                current.fade_out(remaining)
+                upcoming.fade_in(remaining)
+
+        other = upcoming.read()
+        return mix(data, other) if other else data
+
+    @staticmethod
+    def __near_end(source, seconds):
+        duration = source.track.duration
+        return duration is not None and source.elapsed >= duration - seconds
+
+    def cleanup(self):
+        self.clear_next()
+        self.current.cleanup()
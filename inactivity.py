@@ -0,0 +1,90 @@
+import heapq
+import logging
+import os
+
+
+inactivity_timeout = float(os.getenv("inactivity_timeout", "300"))
+
+
+class InactivityTimers:
+    """One idle timer per guild, all driven by a single loop callback armed for the earliest deadline.
+
+    Resetting a guild's timer pushes a new deadline onto a heap and leaves the old one behind. Entries that no longer
+    match the guild's current deadline are skipped when they reach the top, so reset and cancel never search the
+    heap. on_idle(guild_id, context) is run as a task when a guild's deadline passes without a reset or cancel.
+    """
+
+    def __init__(self, loop, on_idle, timeout=inactivity_timeout):
+        self.loop = loop
+        self.on_idle = on_idle
+        self.timeout = timeout
+
+        # guild id -> (deadline, context) of the guilds with a running timer
+        self.__deadlines = {}
+        self.__heap = []
+        self.__handle = None
+        self.__handle_deadline = None
+
+    def __contains__(self, guild_id):
+        return guild_id in self.__deadlines
+
+    def __len__(self):
+        return len(self.__deadlines)
+
+    def reset(self, guild_id, context):
+        """Starts the guild's timer again from the full timeout"""
+
+        deadline = self.loop.time() + self.timeout
+        self.__deadlines[guild_id] = (deadline, context)
+        heapq.heappush(self.__heap, (deadline, guild_id))
+        if len(self.__heap) > 2 * len(self.__deadlines) + 64:
+            # Lots of resets leave lots of stale entries behind, drop them all at once
+            self.__heap = [(deadline, guild_id) for guild_id, (deadline, _) in self.__deadlines.items()]
+            heapq.heapify(self.__heap)
+        self.__arm()
+
+    def cancel(self, guild_id):
+        self.__deadlines.pop(guild_id, None)
+
+    def cancel_all(self):
+        self.__deadlines.clear()
+        self.__heap.clear()
+        if self.__handle is not None:
+            self.__handle.cancel()
+            self.__handle = None
+
+    def __is_current(self, entry):
+        deadline, guild_id = entry
+        current = self.__deadlines.get(guild_id)
+        return current is not None and current[0] == deadline
+
+    def __arm(self):
+        while self.__heap and not self.__is_current(self.__heap[0]):
+            heapq.heappop(self.__heap)
+        if not self.__heap:
+            return
+
+        deadline = self.__heap[0][0]
+        if self.__handle is not None:
+            if self.__handle_deadline <= deadline:
+                return
+            self.__handle.cancel()
+        self.__handle = self.loop.call_at(deadline, self.__fire)
+        self.__handle_deadline = deadline
+
+    def __fire(self):
+        self.__handle = None
+        now = self.loop.time()
+        while self.__heap and self.__heap[0][0] <= now:
+            entry = heapq.heappop(self.__heap)
+            if not self.__is_current(entry):
+                continue
+            _, context = self.__deadlines.pop(entry[1])
+            task = self.loop.create_task(self.on_idle(entry[1], context))
+            task.add_done_callback(self.__log_failure)
+        self.__arm()
+
+    @staticmethod
+    def __log_failure(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.getLogger().log(logging.ERROR, f"Error disconnecting an idle guild. Message: {task.exception()}")
@@ -0,0 +1,68 @@
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+import metrics
+
+
+# Seconds the event loop may go without running a callback before what it is stuck on gets logged, 0 turns it off
+loop_lag_threshold = float(os.getenv("loop_lag_threshold", "0.25"))
+# Seconds between two lag measurements
+loop_lag_interval = 1.0
+
+
+class LoopWatchdog:
+    """Measures how long the event loop takes to get to a callback, from a thread of its own so it keeps measuring
+    while the loop is blocked.
+
+    Every interval the thread schedules a callback on the loop and waits for it. If it hasn't run after threshold
+    seconds the thread logs a stack sample of the loop's thread, showing what is holding it up, and logs again how
+    long the loop was blocked once the callback gets to run. Every measurement is recorded in the loop lag metric.
+    """
+
+    def __init__(self, loop, threshold=loop_lag_threshold, interval=loop_lag_interval):
+        self.loop = loop
+        self.threshold = threshold
+        self.interval = interval
+
+        self.__loop_thread = None
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        """Starts watching the loop. Has to be called from the loop's thread"""
+
+        self.__loop_thread = threading.get_ident()
+        self.__stopped.clear()
+        self.__thread = threading.Thread(target=self.__run, name="loop-watchdog", daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __run(self):
+        while not self.__stopped.wait(self.interval):
+            ran = threading.Event()
+            scheduled = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(ran.set)
+            except RuntimeError:
+                # The loop was closed
+                return
+
+            if not ran.wait(self.threshold):
+                self.__log_blocked()
+                while not ran.wait(self.interval):
+                    if self.__stopped.is_set() or self.loop.is_closed():
+                        return
+                lag = time.monotonic() - scheduled
+                logging.getLogger().log(logging.WARNING, f"The event loop was blocked for {lag:.2f} seconds")
+            metrics.loop_lag_seconds.observe(time.monotonic() - scheduled)
+
+    def __log_blocked(self):
+        frame = sys._current_frames().get(self.__loop_thread)
+        stack = "".join(traceback.format_stack(frame)) if frame is not None else "(no stack)"
+        logging.getLogger().log(logging.WARNING, f"The event loop has been blocked for over {self.threshold} seconds. "
+                                                 f"It is running:\n{stack}")
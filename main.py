@@ -1,6 +1,39 @@
 import asyncio
+import multiprocessing
+import os
 from discord_bot import main
 
 
-if __name__ == "__main__":
+def run_sharded(shard_count, processes):
+    """Runs the bot as several processes, each connecting a contiguous range of the shards. The processes have to
+    share their state through the redis db backend"""
+
+    shards_per_process = -(-shard_count // processes)
+    metrics_port = os.getenv("metrics_port")
+    workers = []
+    for index, first_shard in enumerate(range(0, shard_count, shards_per_process)):
+        shard_ids = range(first_shard, min(first_shard + shards_per_process, shard_count))
+        # Read by discord_bot when the spawned process imports it
+        os.environ["shard_count"] = str(shard_count)
+        os.environ["shard_ids"] = ",".join(str(shard_id) for shard_id in shard_ids)
+        if metrics_port is not None:
+            # Every process serves its own metrics on the next port up
+            os.environ["metrics_port"] = str(int(metrics_port) + index)
+        worker = multiprocessing.get_context("spawn").Process(target=run, name=f"shards-{shard_ids[0]}")
+        worker.start()
+        workers.append(worker)
+
+    for worker in workers:
+        worker.join()
+
+
+def run():
     asyncio.run(main())
+
+
+if __name__ == "__main__":
+    shard_processes = int(os.getenv("shard_processes", "1"))
+    if shard_processes > 1:
+        run_sharded(int(os.getenv("shard_count", str(shard_processes))), shard_processes)
+    else:
+        run()
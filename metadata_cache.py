@@ -0,0 +1,118 @@
+import json
+import re
+import sqlite3
+import time
+
+
+class MetadataCache:
+    """SQLite backed cache of resolved track metadata, keyed by the normalised url or search query.
+
+    A secondary index on the track key lets a different url of an already resolved video skip yt-dlp too. Only
+    long lived metadata is stored, media urls expire too quickly to be worth caching.
+
+    Lookups run on the event loop, so they are kept to a single indexed read. The last used times of hits are
+    written in batches along with the next insert, and the size limit is only enforced every trim_interval inserts.
+    """
+
+    # Hits whose last used time is written at once
+    touch_batch_size = 100
+    trim_interval = 100
+
+    def __init__(self, path, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        # query -> last used time of hits not written yet
+        self.__touched = {}
+        self.__inserts = 0
+
+        self.__connection = sqlite3.connect(path)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        # A crash can only lose the last few commits, it can't corrupt the database. Commits don't wait for an fsync
+        self.__connection.execute("PRAGMA synchronous=NORMAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS metadata ("
+            "query TEXT PRIMARY KEY, track_key TEXT NOT NULL, info TEXT NOT NULL, created REAL NOT NULL, "
+            "last_used REAL NOT NULL)"
+        )
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS metadata_track_key ON metadata (track_key)")
+        self.__connection.execute("CREATE INDEX IF NOT EXISTS metadata_last_used ON metadata (last_used)")
+        self.__connection.commit()
+        self.prune()
+
+    @staticmethod
+    def normalise(query):
+        query = query.strip()
+        if re.match(r'^https?://', query):
+            return query
+        # Search queries only differ by case and spacing as far as the search is concerned
+        return " ".join(query.casefold().split())
+
+    def get(self, query):
+        return self.__get("query = ?", self.normalise(query))
+
+    def get_by_key(self, track_key):
+        return self.__get("track_key = ?", track_key)
+
+    def put(self, query, track_key, info):
+        now = time.time()
+        self.__connection.execute(
+            "INSERT OR REPLACE INTO metadata (query, track_key, info, created, last_used) VALUES (?, ?, ?, ?, ?)",
+            (self.normalise(query), track_key, json.dumps(info), now, now)
+        )
+        self.__write_touched()
+        self.__connection.commit()
+        self.__inserts += 1
+        if self.__inserts % self.trim_interval == 0:
+            self.__trim()
+
+    def prune(self):
+        """Removes expired entries and the least recently used entries over the size limit"""
+
+        self.__connection.execute("DELETE FROM metadata WHERE created < ?", (time.time() - self.ttl,))
+        self.__write_touched()
+        self.__connection.commit()
+        self.__trim()
+
+    def close(self):
+        self.__write_touched()
+        self.__connection.commit()
+        self.__connection.close()
+
+    def __get(self, condition, value):
+        row = self.__connection.execute(
+            f"SELECT query, info, created FROM metadata WHERE {condition} ORDER BY created DESC LIMIT 1", (value,)
+        ).fetchone()
+
+        if row is None or row[2] < time.time() - self.ttl:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.__touched[row[0]] = time.time()
+        if len(self.__touched) >= self.touch_batch_size:
+            self.__write_touched()
+            self.__connection.commit()
+        return json.loads(row[1])
+
+    def __write_touched(self):
+        """Queues the pending last used times in the current transaction, the caller commits"""
+
+        if not self.__touched:
+            return
+        self.__connection.executemany("UPDATE metadata SET last_used = ? WHERE query = ?",
+                                      [(last_used, query) for query, last_used in self.__touched.items()])
+        self.__touched.clear()
+
+    def __trim(self):
+        (count,) = self.__connection.execute("SELECT COUNT(*) FROM metadata").fetchone()
+        if count <= self.max_entries:
+            return
+
+        self.__connection.execute(
+            "DELETE FROM metadata WHERE query IN (SELECT query FROM metadata ORDER BY last_used LIMIT ?)",
+            (count - self.max_entries,)
+        )
+        self.__connection.commit()
@@ -0,0 +1,189 @@
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+from aiohttp import web
+
+
+# The endpoint is off unless a port is set. It binds to localhost by default, the metrics aren't meant to be public
+metrics_port = os.getenv("metrics_port")
+metrics_host = os.getenv("metrics_host", "127.0.0.1")
+
+latency_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+size_buckets = tuple(2 ** exponent * 1024 * 1024 for exponent in range(-2, 8))
+
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Histogram:
+    """Cumulative histogram in the Prometheus text format. Observations can come from any thread, the audio thread
+    records when playback starts"""
+
+    def __init__(self, name, documentation, buckets=latency_buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+        self.__lock = threading.Lock()
+        self.__counts = [0] * len(self.buckets)
+        self.__sum = 0.0
+
+    def observe(self, value):
+        with self.__lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.__counts[i] += 1
+                    break
+            self.__sum += value
+
+    @contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+    def render(self):
+        with self.__lock:
+            counts = list(self.__counts)
+            total = self.__sum
+
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{format_value(bound)}"}} {cumulative}')
+        lines.append(f"{self.name}_sum {format_value(total)}")
+        lines.append(f"{self.name}_count {cumulative}")
+        return lines
+
+
+class Counter:
+    """Count that only goes up, e.g. of events. Like histograms it can be incremented from any thread"""
+
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+
+        self.__lock = threading.Lock()
+        self.__value = 0
+
+    def inc(self, amount=1):
+        with self.__lock:
+            self.__value += amount
+
+    def render(self):
+        with self.__lock:
+            value = self.__value
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter",
+                f"{self.name} {format_value(value)}"]
+
+
+class Gauge:
+    """Gauge read when the endpoint is scraped. The function returns a number, or with a label a dict from label
+    value to number"""
+
+    def __init__(self, name, documentation, function, label=None):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+        self.label = label
+
+    def render(self, value):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge"]
+        if self.label is None:
+            lines.append(f"{self.name} {format_value(value)}")
+        else:
+            for label_value, sample in value.items():
+                lines.append(f"{self.name}{format_labels({self.label: label_value})} {format_value(sample)}")
+        return lines
+
+
+extract_seconds = Histogram("musicbot_extract_seconds", "Time yt-dlp spent in extract_info without downloading")
+download_seconds = Histogram("musicbot_download_seconds", "Time spent downloading a track")
+download_bytes = Histogram("musicbot_download_bytes", "Size of downloaded tracks", buckets=size_buckets)
+ffmpeg_spawn_seconds = Histogram("musicbot_ffmpeg_spawn_seconds", "Time spent starting ffmpeg for a track")
+play_to_audio_seconds = Histogram("musicbot_play_to_audio_seconds",
+                                  "Time from a play command to the first audio frame of its track")
+loop_lag_seconds = Histogram("musicbot_event_loop_lag_seconds",
+                             "Delay before a callback scheduled on the event loop got to run")
+
+histograms = [extract_seconds, download_seconds, download_bytes, ffmpeg_spawn_seconds, play_to_audio_seconds,
+              loop_lag_seconds]
+
+admission_rejections = Counter("musicbot_admission_rejections_total", "Requests turned away by the admission limits")
+
+counters = [admission_rejections]
+# Registered by the parts of the bot that own the values, keyed by name so registering again replaces a gauge
+gauges = {}
+
+
+def register_gauge(name, documentation, function, label=None):
+    gauges[name] = Gauge(name, documentation, function, label)
+
+
+async def read_gauge(gauge):
+    """Gauges that have to look at the disk are coroutine functions, so the endpoint can run them off the loop"""
+
+    value = gauge.function()
+    if hasattr(value, "__await__"):
+        value = await value
+    return value
+
+
+async def render():
+    lines = []
+    for histogram in histograms:
+        lines.extend(histogram.render())
+    for counter in counters:
+        lines.extend(counter.render())
+    for gauge in list(gauges.values()):
+        try:
+            lines.extend(gauge.render(await read_gauge(gauge)))
+        except Exception as e:
+            logging.getLogger().log(logging.ERROR, f"Error reading the {gauge.name} metric. Message: {e}")
+    return "\n".join(lines) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(text=await render(), headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+async def start_server(port, host=metrics_host):
+    """Serves the metrics on http://host:port/metrics and returns the runner to clean up on shutdown"""
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, int(port)).start()
+    logging.getLogger().log(logging.INFO, f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
+
+
+def directory_size(path):
+    """Bytes used by the files directly in a directory"""
+
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    total += entry.stat(follow_symlinks=False).st_size
+    except FileNotFoundError:
+        pass
+    return total
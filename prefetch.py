@@ -0,0 +1,91 @@
+import asyncio
+import logging
+import os
+from ytdl import download_track
+
+
+prefetch_depth = int(os.getenv("prefetch_depth", "2"))
+max_concurrent_downloads = int(os.getenv("max_concurrent_downloads", "2"))
+
+
+class Prefetcher:
+    """Downloads the tracks at the front of each guild's queue in the background, so they are already on disk when
+    they start playing. Downloads are shared between guilds queueing the same track."""
+
+    READY = "ready"
+    DOWNLOADING = "downloading"
+    WAITING = "waiting"
+
+    def __init__(self, db, cache, scheduler, depth=prefetch_depth, max_downloads=max_concurrent_downloads):
+        self.db = db
+        self.cache = cache
+        self.scheduler = scheduler
+        self.loop = scheduler.loop
+        self.depth = depth
+        self.__semaphore = asyncio.Semaphore(max_downloads)
+        self.__downloads = {}
+
+    def schedule(self, guild_id):
+        """Starts downloading the next few tracks of a guild's queue that aren't on disk yet"""
+
+        for track in self.db.get_queue_slice(guild_id, 0, self.depth):
+            self.__start_download(track, guild_id)
+
+    def prefetch(self, track, guild_id):
+        """Starts downloading a single track in the background"""
+
+        self.__start_download(track, guild_id)
+
+    @property
+    def downloads(self):
+        """Downloads running or waiting for a free slot"""
+
+        return len(self.__downloads)
+
+    def is_ready(self, track):
+        return track.key in self.cache
+
+    def status(self, track):
+        return self.key_status(track.key)
+
+    def key_status(self, key):
+        if key in self.cache:
+            return self.READY
+        elif key in self.__downloads:
+            return self.DOWNLOADING
+        return self.WAITING
+
+    async def ensure_ready(self, track, guild_id):
+        """Waits until the track's file is on disk, downloading it now if it wasn't prefetched"""
+
+        filepath = None
+        task = self.__start_download(track, guild_id)
+        if task is not None:
+            filepath = await task
+        track.filepath = self.cache.cached_filepath(track.key) or filepath
+        if track.loudness is None:
+            track.loudness = self.cache.loudness(track.key)
+
+    def __start_download(self, track, guild_id):
+        if track.key in self.cache:
+            return None
+
+        task = self.__downloads.get(track.key)
+        if task is None:
+            task = self.loop.create_task(self.__download(track.key, track.original_url, guild_id))
+            self.__downloads[track.key] = task
+            # Errors are logged in __download, nobody might be waiting on a background download
+            task.add_done_callback(lambda t: t.cancelled() or t.exception())
+        return task
+
+    async def __download(self, key, url, guild_id):
+        try:
+            async with self.__semaphore:
+                logging.getLogger().log(logging.INFO, f"Downloading {key}")
+                return await download_track(url, key, scheduler=self.scheduler, guild_id=guild_id,
+                                            cache=self.cache)
+        except Exception as e:
+            logging.getLogger().log(logging.ERROR, f"Error downloading {key}. Message: {e}")
+            raise
+        finally:
+            del self.__downloads[key]
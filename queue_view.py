@@ -0,0 +1,104 @@
+import os
+from collections import OrderedDict
+import discord
+
+
+queue_page_size = int(os.getenv("queue_page_size", "10"))
+max_title_length = 80
+
+
+def format_duration(seconds):
+    if seconds is None:
+        return "?:??"
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+class QueueRenderer:
+    """Renders pages of a guild's queue. Rendered pages are cached until the guild's queue changes or the download
+    state of one of the songs on the page does, so showing the queue again after every command costs nothing"""
+
+    def __init__(self, db, prefetcher, page_size=queue_page_size, max_cached_pages=256):
+        self.db = db
+        self.prefetcher = prefetcher
+        self.page_size = page_size
+        self.max_cached_pages = max_cached_pages
+        self.__pages = OrderedDict()
+        self.__totals = {}
+
+    def page_count(self, guild_id):
+        return max(1, -(-(self.db.queue_size(guild_id) or 0) // self.page_size))
+
+    def render(self, guild_id, page):
+        """Returns the text of a 1 based page of the queue, pages out of range are clamped"""
+
+        page = min(max(page, 1), self.page_count(guild_id))
+        cache_key = (guild_id, self.db.queue_version(guild_id), page)
+        cached = self.__pages.get(cache_key)
+        if cached is not None:
+            content, keys, statuses = cached
+            # Downloads in other guilds don't touch this page unless they are of a song shown on it
+            if statuses == tuple(self.prefetcher.key_status(key) for key in keys):
+                self.__pages.move_to_end(cache_key)
+                return content
+
+        content, keys, statuses = self.__render(guild_id, page)
+        self.__pages[cache_key] = (content, keys, statuses)
+        if len(self.__pages) > self.max_cached_pages:
+            self.__pages.popitem(last=False)
+        return content
+
+    def __total_duration(self, guild_id):
+        version = self.db.queue_version(guild_id)
+        total = self.__totals.get(guild_id)
+        if total is None or total[0] != version:
+            queue = self.db.get_queue_with_guild_id(guild_id) or ()
+            total = (version, sum(track.duration or 0 for track in queue))
+            self.__totals[guild_id] = total
+        return total[1]
+
+    def __render(self, guild_id, page):
+        """Returns the page's text along with the keys of the songs on it and their download states"""
+
+        start = (page - 1) * self.page_size
+        tracks = self.db.get_queue_slice(guild_id, start, start + self.page_size)
+        keys = tuple(track.key for track in tracks)
+        statuses = tuple(self.prefetcher.key_status(key) for key in keys)
+
+        song_list = ""
+        for num, (track, status) in enumerate(zip(tracks, statuses), start=start + 1):
+            title = track.title or track.original_url
+            if len(title) > max_title_length:
+                title = title[:max_title_length - 1] + "…"
+            song_list += f"> **{num}.** {title} `{format_duration(track.duration)}` *[{status}]*\n"
+
+        content = (
+            f"Number of songs in queue: {self.db.queue_size(guild_id)} "
+            f"*(total {format_duration(self.__total_duration(guild_id))})*\n"
+            f"{song_list}"
+            f"Page {page}/{self.page_count(guild_id)}"
+        )
+        return content, keys, statuses
+
+
+class QueuePageView(discord.ui.View):
+    """Previous and next page buttons under a queue listing"""
+
+    def __init__(self, renderer, guild_id, page, timeout=120):
+        super().__init__(timeout=timeout)
+        self.renderer = renderer
+        self.guild_id = guild_id
+        self.page = page
+
+    async def show_page(self, interaction, page):
+        self.page = min(max(page, 1), self.renderer.page_count(self.guild_id))
+        await interaction.response.edit_message(content=self.renderer.render(self.guild_id, self.page), view=self)
+
+    @discord.ui.button(label="◀", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self.show_page(interaction, self.page - 1)
+
+    @discord.ui.button(label="▶", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self.show_page(interaction, self.page + 1)
@@ -0,0 +1,65 @@
+class GuildSession:
+    """State of a guild the bot is connected to a voice channel in"""
+
+    __slots__ = ("guild_id", "voice_client", "channel_id", "player", "chain", "playback_mode")
+
+    def __init__(self, guild_id, voice_client, playback_mode):
+        self.guild_id = guild_id
+        self.voice_client = voice_client
+        self.channel_id = voice_client.channel.id
+        # Audio source the voice client is playing, None between songs
+        self.player = None
+        # GaplessSource the voice client is playing, holding player and the next song once it is opened
+        self.chain = None
+        self.playback_mode = playback_mode
+
+
+class SessionRegistry:
+    """Sessions indexed by guild id and by voice channel id, so voice events and playback callbacks find their
+    session, or find out the bot isn't active there, with a single dict lookup"""
+
+    def __init__(self, default_playback_mode):
+        self.default_playback_mode = default_playback_mode
+        self.__by_guild = {}
+        self.__by_channel = {}
+
+    def __len__(self):
+        return len(self.__by_guild)
+
+    def __contains__(self, guild_id):
+        return guild_id in self.__by_guild
+
+    def get(self, guild_id):
+        return self.__by_guild.get(guild_id)
+
+    def by_channel(self, channel_id):
+        return self.__by_channel.get(channel_id)
+
+    def open(self, guild_id, voice_client):
+        """Returns the guild's session, creating it if there isn't one yet. The session takes over the given voice
+        client and its channel"""
+
+        session = self.__by_guild.get(guild_id)
+        if session is None:
+            session = GuildSession(guild_id, voice_client, self.default_playback_mode)
+            self.__by_guild[guild_id] = session
+        else:
+            session.voice_client = voice_client
+            self.move(guild_id, voice_client.channel.id)
+        self.__by_channel[session.channel_id] = session
+        return session
+
+    def move(self, guild_id, channel_id):
+        session = self.__by_guild.get(guild_id)
+        if session is None:
+            return
+        if self.__by_channel.get(session.channel_id) is session:
+            del self.__by_channel[session.channel_id]
+        session.channel_id = channel_id
+        self.__by_channel[channel_id] = session
+
+    def close(self, guild_id):
+        session = self.__by_guild.pop(guild_id, None)
+        if session is not None and self.__by_channel.get(session.channel_id) is session:
+            del self.__by_channel[session.channel_id]
+        return session
@@ -0,0 +1,92 @@
+import logging
+import os
+import discord
+
+
+status_update_interval = float(os.getenv("status_update_interval", "3"))
+
+
+class StatusMessages:
+    """One message per guild showing what is playing and the front of the queue, edited in place instead of
+    replying to every command.
+
+    Updates are coalesced: a guild's message is edited at most once per interval, with whatever the state is by the
+    time the edit goes out. render(guild_id, note) returns the text of the message, note being the last action
+    passed to update.
+    """
+
+    def __init__(self, loop, render, interval=status_update_interval):
+        self.loop = loop
+        self.render = render
+        self.interval = interval
+
+        self.__messages = {}
+        # guild id -> context the message is sent through if there is no message to edit yet
+        self.__contexts = {}
+        self.__notes = {}
+        self.__dirty = set()
+        # guild id -> timer handle or task of the guild's next edit
+        self.__scheduled = {}
+        self.__last_edit = {}
+
+    def update(self, guild_id, ctx, note=None):
+        self.__contexts[guild_id] = ctx
+        if note is not None:
+            self.__notes[guild_id] = note
+        self.__dirty.add(guild_id)
+        if guild_id not in self.__scheduled:
+            self.__schedule(guild_id)
+
+    def close(self, guild_id):
+        """Stops updating a guild's message, the next update posts a new one"""
+
+        scheduled = self.__scheduled.pop(guild_id, None)
+        if scheduled is not None:
+            scheduled.cancel()
+        for state in (self.__messages, self.__contexts, self.__notes, self.__last_edit):
+            state.pop(guild_id, None)
+        self.__dirty.discard(guild_id)
+
+    def close_all(self):
+        for guild_id in list(self.__scheduled):
+            self.close(guild_id)
+
+    def __schedule(self, guild_id):
+        last_edit = self.__last_edit.get(guild_id)
+        delay = 0 if last_edit is None else max(0.0, last_edit + self.interval - self.loop.time())
+        self.__scheduled[guild_id] = self.loop.call_later(delay, self.__start_edit, guild_id)
+
+    def __start_edit(self, guild_id):
+        task = self.loop.create_task(self.__edit(guild_id))
+        # Still counts as scheduled while the edit runs, updates in the meantime wait for the next one
+        self.__scheduled[guild_id] = task
+        task.add_done_callback(lambda t, guild_id=guild_id: self.__edit_finished(guild_id, t))
+
+    async def __edit(self, guild_id):
+        self.__dirty.discard(guild_id)
+        ctx = self.__contexts[guild_id]
+        content = self.render(guild_id, self.__notes.get(guild_id))
+
+        message = self.__messages.get(guild_id)
+        if message is not None and message.channel.id != ctx.channel.id:
+            # Commands moved to another channel, the status follows them
+            message = None
+        if message is not None:
+            try:
+                await message.edit(content=content)
+                return
+            except discord.NotFound:
+                pass
+        self.__messages[guild_id] = await ctx.send(content)
+
+    def __edit_finished(self, guild_id, task):
+        if self.__scheduled.get(guild_id) is not task:
+            # The guild was closed while its edit was running
+            return
+        del self.__scheduled[guild_id]
+        self.__last_edit[guild_id] = self.loop.time()
+
+        if not task.cancelled() and task.exception() is not None:
+            logging.getLogger().log(logging.ERROR, f"Error updating the status message. Message: {task.exception()}")
+        if guild_id in self.__dirty:
+            self.__schedule(guild_id)
@@ -0,0 +1,130 @@
+import os
+import discord
+import pytest
+
+
+class FakeYoutubeDL:
+    """Stands in for yt_dlp.YoutubeDL. Nothing goes to the network, downloads write a small file"""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def extract_info(self, url, download=False):
+        video_id = url.rsplit("=", 1)[-1]
+        data = {
+            "id": video_id,
+            "title": f"Test song {video_id}",
+            "original_url": url,
+            "webpage_url": url,
+            "duration": 180,
+            "extractor_key": "Youtube",
+            "url": f"https://media.invalid/{video_id}",
+        }
+        if download:
+            with open(self.prepare_filename(data), "wb") as f:
+                f.write(b"\0" * 1024)
+        return data
+
+    def prepare_filename(self, data):
+        return os.path.join(self.directory, f"{data['extractor_key']}-{data['id']}.mp3")
+
+
+class FakeSource(discord.AudioSource):
+    """Replaces the ffmpeg backed sources"""
+
+    def __init__(self, track, *, position=0, volume=1.0):
+        self.track = track
+        self.volume = volume
+
+    def read(self):
+        return b"\0" * 3840
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+
+
+class FakeVoiceClient:
+    def __init__(self, channel_id):
+        self.channel = FakeChannel(channel_id)
+        self.source = None
+
+    def play(self, source, *, after=None):
+        self.source = source
+
+    def is_playing(self):
+        return self.source is not None
+
+    def is_paused(self):
+        return False
+
+    def is_connected(self):
+        return True
+
+    def stop(self):
+        self.source = None
+
+
+class FakeMessage:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def edit(self, **kwargs):
+        return self
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        return False
+
+
+class FakeGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+
+class FakeContext:
+    """The parts of a commands.Context the Music cog uses, in a guild the bot is already connected in"""
+
+    def __init__(self, guild_id):
+        self.guild = FakeGuild(guild_id)
+        self.channel = FakeChannel(guild_id)
+        self.voice_client = FakeVoiceClient(channel_id=guild_id)
+
+    async def send(self, *args, **kwargs):
+        return FakeMessage(self.channel)
+
+    def typing(self):
+        return FakeTyping()
+
+
+def url_for(guild_id, index):
+    return f"https://www.youtube.com/watch?v=g{guild_id:05d}s{index:04d}"
+
+
+@pytest.fixture
+def bot_settings(monkeypatch, tmp_path):
+    """Points the bot's settings at tmp_path and replaces yt-dlp and ffmpeg with the fakes.
+
+    The bot reads its settings when its modules are first imported, so the values they already hold are patched
+    too. Returns the download directory.
+    """
+
+    download_path = str(tmp_path)
+    metadata_cache_path = str(tmp_path / "metadata.sqlite3")
+    monkeypatch.setenv("downloads_subdirectory", download_path)
+    monkeypatch.setenv("metadata_cache_path", metadata_cache_path)
+
+    import ytdl
+    import discord_bot
+    for module in (ytdl, discord_bot):
+        monkeypatch.setattr(module, "download_path", download_path)
+        monkeypatch.setattr(module, "metadata_cache_path", metadata_cache_path)
+    fake_ytdl = FakeYoutubeDL(download_path)
+    monkeypatch.setattr(ytdl, "get_ytdl", lambda: fake_ytdl)
+    monkeypatch.setattr(discord_bot, "create_source", FakeSource)
+    return download_path
@@ -0,0 +1,95 @@
+import asyncio
+import logging
+import discord
+import fakeredis
+import pytest
+from discord.ext import commands
+
+from cache import AudioCache
+from conftest import FakeContext, url_for
+from data import RedisDb as redis_db_module
+from data.InMemoryDb import InMemoryDb
+from data.RedisDb import RedisDb
+from data.Track import Track
+from metadata_cache import MetadataCache
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    server = fakeredis.FakeServer()
+    monkeypatch.setattr(redis_db_module.redis.Redis, "from_url",
+                        lambda url: fakeredis.FakeRedis(server=server))
+    return server
+
+
+def track(key):
+    return Track(key=key, id=key, title=key, original_url=f"https://example.invalid/{key}", duration=180)
+
+
+def test_queue_round_trip(fake_redis):
+    db = RedisDb("redis://unused")
+    db.add_to_queue(1, track("a"))
+    db.add_to_queue(1, track("b"))
+
+    assert db.queue_size(1) == 2
+    assert db.advance_queue(1).key == "a"
+    assert db.get_now_playing_with_guild_id(1).key == "a"
+    assert [t.key for t in db.get_queue_slice(1, 0, 10)] == ["b"]
+
+
+def test_processes_share_references(fake_redis):
+    released = []
+    first, second = RedisDb("redis://unused"), RedisDb("redis://unused")
+    first.set_release_callback(released.append)
+    first.add_to_queue(1, track("a"))
+    second.add_to_queue(2, track("a"))
+
+    first.clean_up_for_guild_id(1)
+    assert second.is_track_referenced("a")
+    assert released == []
+
+
+def test_restarted_process_loads_the_queues(fake_redis):
+    db = RedisDb("redis://unused")
+    for key in "abcdefg":
+        db.add_to_queue(1, track(key))
+    db.advance_queue(1)
+    db.queue_move(1, 1, 3)
+    db.pop_index_from_queue(2, 1)
+    db.queue_swap(1, 1, 4)
+    db.queue_jump(1, 2)
+    db.set_session(1, 10, 11)
+
+    restarted = RedisDb("redis://unused")
+    assert [t.key for t in restarted.get_queue_with_guild_id(1)] == [t.key for t in db.get_queue_with_guild_id(1)]
+    assert restarted.get_now_playing_with_guild_id(1).key == "a"
+    assert restarted.get_sessions() == {1: (10, 11)}
+    assert restarted.track_reference_count("a") == 1
+
+
+async def play_first_song(db, download_path):
+    import discord_bot
+
+    bot = commands.Bot(command_prefix="^", intents=discord.Intents.default())
+    async with bot:
+        bot.logger = logging.getLogger()
+        cache = AudioCache(download_path, 1024 * 1024, is_pinned=db.is_track_referenced)
+        metadata_cache = MetadataCache(discord_bot.metadata_cache_path, 60, 100)
+        cog = discord_bot.Music(bot, db, cache, metadata_cache)
+        await bot.add_cog(cog)
+
+        ctx = FakeContext(guild_id=1)
+        await cog.ensure_voice(ctx)
+        await cog.play(ctx, url=url_for(1, 0))
+        source = ctx.voice_client.source
+        await bot.remove_cog("Music")
+        return source
+
+
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+def test_play_starts_the_song(fake_redis, bot_settings, backend):
+    db = InMemoryDb() if backend == "memory" else RedisDb("redis://unused")
+    source = asyncio.run(play_first_song(db, bot_settings))
+
+    assert source is not None
+    assert source.current.track.key == db.get_now_playing_with_guild_id(1).key
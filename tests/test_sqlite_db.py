@@ -0,0 +1,79 @@
+import asyncio
+import random
+
+from data.SqliteDb import SqliteDb
+from data.Track import Track
+
+
+def track(key):
+    return Track(key=key, id=key, title=key, original_url=f"https://example.invalid/{key}", duration=180)
+
+
+def keys(queue):
+    return [item.key for item in queue or ()]
+
+
+def queued_keys(db):
+    # Empty queues have no rows, so they aren't there after reopening
+    return {guild_id: keys(queue) for guild_id, queue in db.get_queues().items() if queue}
+
+
+def test_reopened_db_has_the_same_queues(tmp_path):
+    path = tmp_path / "db.sqlite3"
+    rng = random.Random(0)
+    db = SqliteDb(path)
+    for i in range(40):
+        db.add_to_queue(1, track(f"a{i}"))
+        db.add_to_queue(2, track(f"b{i}"))
+    db.advance_queue(1)
+    db.pop_index_from_queue(1, 1)
+    db.queue_jump(1, 5)
+    db.queue_move(2, 3, 9)
+    db.add_to_queue(2, track("b-last"))
+    db.advance_queue(2)
+    db.queue_remove_range(2, 2, 4)
+    db.add_to_queue(1, track("a-last"))
+    db.set_session(1, 10, 11)
+    for _ in range(200):
+        guild_id = rng.choice([1, 2])
+        operation = rng.choice(["add", "advance", "pop", "jump", "shuffle"])
+        size = db.queue_size(guild_id) or 0
+        if operation == "add":
+            db.add_to_queue(guild_id, track(f"r{rng.random()}"))
+        elif operation == "advance":
+            db.advance_queue(guild_id)
+        elif operation == "pop" and size:
+            db.pop_index_from_queue(rng.randint(1, size), guild_id)
+        elif operation == "jump" and size:
+            db.queue_jump(guild_id, rng.randint(1, size))
+        elif operation == "shuffle":
+            db.queue_shuffle(guild_id)
+    expected = queued_keys(db)
+    now_playing = db.get_now_playing_with_guild_id(2).key
+    db.close()
+
+    reopened = SqliteDb(path)
+    assert queued_keys(reopened) == expected
+    assert reopened.get_now_playing_with_guild_id(2).key == now_playing
+    assert reopened.get_sessions() == {1: (10, 11)}
+    reopened.close()
+
+
+def test_changes_are_written_off_the_loop(tmp_path):
+    path = tmp_path / "db.sqlite3"
+
+    async def play():
+        db = SqliteDb(path, flush_interval=0)
+        db.add_to_queue(1, track("a"))
+        db.add_to_queue(1, track("b"))
+        db.advance_queue(1)
+        db.set_session(1, 10, 11)
+        await asyncio.sleep(0.01)
+        db.close()
+
+    asyncio.run(play())
+    reopened = SqliteDb(path)
+    assert keys(reopened.get_queue_with_guild_id(1)) == ["b"]
+    assert reopened.get_now_playing_with_guild_id(1).key == "a"
+    assert reopened.get_sessions() == {1: (10, 11)}
+    reopened.close()
@@ -0,0 +1,65 @@
+import random
+import pytest
+
+from data.TrackQueue import TrackQueue
+
+
+@pytest.fixture(autouse=True)
+def small_blocks(monkeypatch):
+    # Small blocks so a few dozen items already span many of them
+    monkeypatch.setattr(TrackQueue, "load", 4)
+
+
+def test_matches_a_list():
+    rng = random.Random(0)
+    expected = list(range(50))
+    queue = TrackQueue(expected)
+    for step in range(5000):
+        operation = rng.choice(["append", "popleft", "pop", "insert", "move", "swap", "remove_range", "slice"])
+        if operation == "append":
+            expected.append(step + 100)
+            queue.append(step + 100)
+        elif not expected:
+            continue
+        elif operation == "popleft":
+            assert queue.popleft() == expected.pop(0)
+        elif operation == "pop":
+            index = rng.randrange(len(expected))
+            assert queue.pop(index) == expected.pop(index)
+        elif operation == "insert":
+            index = rng.randrange(len(expected) + 1)
+            expected.insert(index, step + 100)
+            queue.insert(index, step + 100)
+        elif operation == "move":
+            original, new = rng.randrange(len(expected)), rng.randrange(len(expected))
+            expected.insert(new, expected.pop(original))
+            queue.move(original, new)
+        elif operation == "swap":
+            first, second = rng.randrange(len(expected)), rng.randrange(len(expected))
+            expected[first], expected[second] = expected[second], expected[first]
+            queue.swap(first, second)
+        elif operation == "remove_range":
+            start = rng.randrange(len(expected))
+            stop = rng.randrange(start, len(expected) + 1)
+            assert queue.remove_range(start, stop) == expected[start:stop]
+            del expected[start:stop]
+        else:
+            start = rng.randrange(len(expected))
+            stop = rng.randrange(start, len(expected) + 1)
+            assert queue.slice(start, stop) == expected[start:stop]
+
+        assert len(queue) == len(expected)
+        if expected:
+            index = rng.randrange(len(expected))
+            assert queue[index] == expected[index]
+    assert list(queue) == expected
+
+
+def test_remove_range_keeps_the_order():
+    queue = TrackQueue(range(20))
+
+    assert queue.remove_range(0, 1) == [0]
+    assert queue.remove_range(2, 11) == [3, 4, 5, 6, 7, 8, 9, 10, 11]
+    assert queue.remove_range(5, 5) == []
+    assert list(queue) == [1, 2, 12, 13, 14, 15, 16, 17, 18, 19]
+    assert queue[2] == 12
@@ -1,19 +1,40 @@
 from __future__ import unicode_literals
 from dotenv import load_dotenv
-import asyncio
+import fcntl
 import os
+import re
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
 import discord
 import yt_dlp as youtube_dl
+from yt_dlp.extractor import gen_extractor_classes
+from data.Track import Track
+import metrics
+from audio_transform import PCMTransformer
 
 
 load_dotenv()
 pwd = os.getcwd()
 download_subdirectory = os.getenv("downloads_subdirectory")
 download_path = os.path.join(pwd, download_subdirectory)
+cache_max_bytes = int(os.getenv("cache_max_megabytes", "1024")) * 1024 * 1024
+cache_eviction_policy = os.getenv("cache_eviction_policy", "lru")
+default_playback_mode = os.getenv("playback_mode", "download")
+stream_cache_fill = os.getenv("stream_cache_fill", "1") == "1"
+metadata_cache_path = os.getenv("metadata_cache_path", os.path.join(download_path, "metadata.sqlite3"))
+metadata_cache_ttl = int(os.getenv("metadata_cache_ttl", str(24 * 60 * 60)))
+metadata_cache_max_entries = int(os.getenv("metadata_cache_max_entries", "10000"))
+opus_cache = os.getenv("opus_cache", "0") == "1"
+max_playlist_size = int(os.getenv("max_playlist_size", "100"))
+loudness_normalization = os.getenv("loudness_normalization", "1") == "1"
+loudness_target = float(os.getenv("loudness_target", "-14"))
+playlist_batch_size = 25
 
 ytdl_format_options = {
     'format': 'bestaudio/best',
-    'outtmpl': os.path.join(download_path, '%(id)s.mp3'),
+    'outtmpl': os.path.join(download_path, '%(extractor_key)s-%(id)s.mp3'),
     'restrictfilenames': True,
     'noplaylist': True,
     'ignoreerrors': False,
@@ -25,35 +46,440 @@ ytdl_format_options = {
     # https://ffmpeg.org/ffmpeg-protocols.html#http
 }
 
+# Only lists the ids and titles of playlist entries, each entry is resolved properly once it is about to play
+playlist_format_options = dict(ytdl_format_options, noplaylist=False, extract_flat='in_playlist')
+
 ffmpeg_options = {
     'options': '-vn',
 }
 
-ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+# Only ffmpeg understands the reconnect options, yt-dlp ignores them
+stream_ffmpeg_options = {
+    'before_options': ytdl_format_options['before_options'],
+    'options': '-vn',
+}
+
+# Volume new songs start at. Songs in the opus cache are stored with it already applied
+default_volume = 0.5
+opus_bitrate = 128
+
+# Quiet tracks are boosted at most this much, so near silent tracks don't get blown up into noise
+max_loudness_gain = 2.0
+
+# If a stream ends more than this many seconds before the track's duration it is treated as a failed stream
+stream_end_tolerance = 5
+
+extractors = [ie for ie in gen_extractor_classes() if ie.ie_key() != 'Generic']
+cacheable_metadata = ('id', 'title', 'original_url', 'webpage_url', 'duration', 'extractor_key')
+
+# YoutubeDL instances aren't thread safe, so every extraction worker thread or process gets its own
+worker_state = threading.local()
+
+
+def get_ytdl():
+    if not hasattr(worker_state, 'ytdl'):
+        worker_state.ytdl = youtube_dl.YoutubeDL(ytdl_format_options)
+    return worker_state.ytdl
+
+
+def get_playlist_ytdl():
+    if not hasattr(worker_state, 'playlist_ytdl'):
+        worker_state.playlist_ytdl = youtube_dl.YoutubeDL(playlist_format_options)
+    return worker_state.playlist_ytdl
+
+
+def extract(url, download):
+    """Extraction job run on an extraction worker. Only returns the plain metadata the bot needs, so results are
+    cheap to send back from a worker process"""
+
+    start = time.perf_counter()
+    ytdl = get_ytdl()
+    data = first_entry(ytdl.extract_info(url, download=download))
+
+    result = {k: data.get(k) for k in cacheable_metadata}
+    result['url'] = data.get('url')
+    if download:
+        result['filepath'] = ytdl.prepare_filename(data)
+        result['loudness'] = measure_loudness(result['filepath']) if loudness_normalization else None
+        if opus_cache:
+            result['filepath'] = transcode_to_opus(result['filepath'], loudness_gain(result['loudness']))
+        result['filesize'] = os.path.getsize(result['filepath'])
+    # Timed in the worker so the metrics don't include the time spent waiting for a free worker
+    result['elapsed'] = time.perf_counter() - start
+    return result
+
+
+def lock_path(key):
+    return os.path.join(download_path, f"{key}.lock")
+
+
+def locked_file(path, flags=fcntl.LOCK_EX):
+    """Opens and locks the lock file at path. Returns None if flags has LOCK_NB and the file is locked.
+
+    Lock files are deleted by whoever holds them. A process that was waiting on a file that has been deleted in the
+    meantime holds a lock nobody else can see, so it opens the file again"""
+
+    while True:
+        lock = open(path, "w")
+        try:
+            fcntl.flock(lock, flags)
+        except BlockingIOError:
+            lock.close()
+            return None
+        try:
+            if os.path.samestat(os.fstat(lock.fileno()), os.stat(path)):
+                return lock
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+@contextmanager
+def download_lock(key):
+    path = lock_path(key)
+    lock = locked_file(path)
+    try:
+        yield
+    finally:
+        # Deleted while still locked, so nobody can lock the old file and miss the new one
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def remove_stale_locks():
+    """Deletes lock files left behind by processes that died while downloading, or by versions of the bot that
+    kept them. Lock files that are held are left alone"""
+
+    for name in os.listdir(download_path):
+        if not name.endswith(".lock"):
+            continue
+        path = os.path.join(download_path, name)
+        lock = locked_file(path, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if lock is None:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        lock.close()
+
+
+def download(url, key):
+    """Extraction job downloading a track. It holds a lock file for the track while downloading, so bot processes
+    sharing the download directory never download the same track at the same time"""
+
+    with download_lock(key):
+        opus_path = os.path.join(download_path, f"{key}.opus")
+        if opus_cache and os.path.exists(opus_path):
+            # Another process finished it while this one was waiting for the lock
+            result = extract(url, False)
+            result['filepath'] = opus_path
+            result['filesize'] = os.path.getsize(opus_path)
+            return result
+        # yt-dlp already skips downloading files that exist
+        return extract(url, True)
+
+
+def measure_loudness(filepath):
+    """Integrated EBU R128 loudness of a downloaded file in LUFS, or None if ffmpeg couldn't measure it. Measured
+    once per download, so playback only has to apply a fixed gain"""
+
+    try:
+        completed = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-nostats', '-i', filepath, '-vn', '-af', 'ebur128=framelog=verbose',
+             '-f', 'null', '-'],
+            capture_output=True, text=True
+        )
+    except OSError:
+        return None
+    # The summary printed at the end holds the integrated loudness
+    matches = re.findall(r'I:\s+(-?\d+(?:\.\d+)?) LUFS', completed.stderr)
+    if completed.returncode != 0 or not matches:
+        return None
+    return float(matches[-1])
+
+
+def loudness_gain(loudness):
+    """Gain factor bringing a track measured at loudness LUFS to loudness_target"""
+
+    if loudness is None or not loudness_normalization:
+        return 1
+    return min(10 ** ((loudness_target - loudness) / 20), max_loudness_gain)
+
+
+def transcode_to_opus(filepath, gain=1):
+    """Encodes a downloaded file once into 48kHz stereo Opus with the default volume and the loudness gain already
+    applied, so it can be sent to discord as is instead of being decoded, scaled and encoded again for every
+    playback"""
+
+    opus_path = os.path.splitext(filepath)[0] + '.opus'
+    subprocess.run(
+        ['ffmpeg', '-y', '-loglevel', 'error', '-i', filepath, '-vn', '-af', f'volume={default_volume * gain:.3f}',
+         '-c:a', 'libopus', '-b:a', f'{opus_bitrate}k', '-ar', '48000', '-ac', '2', opus_path],
+        check=True
+    )
+    os.remove(filepath)
+    return opus_path
+
+
+def extract_playlist_entries(url, start, end):
+    """Extraction job listing entries start to end (1 based, inclusive) of a playlist without resolving them.
+    Returns the usable entries and how many entries yt-dlp listed, unavailable ones included"""
+
+    ytdl = get_playlist_ytdl()
+    ytdl.params['playlist_items'] = f"{start}-{end}"
+    data = ytdl.extract_info(url, download=False)
+
+    listed = list(data.get('entries', [data]))
+    entries = []
+    for entry in listed:
+        if entry is None or entry.get('id') is None:
+            continue
+        entries.append({
+            'id': entry['id'],
+            'title': entry.get('title'),
+            'duration': entry.get('duration'),
+            'original_url': entry.get('original_url') or entry.get('url'),
+            'extractor_key': entry.get('extractor_key') or entry.get('ie_key'),
+        })
+    return entries, len(listed)
+
+
+def cache_key(data):
+    return f"{data['extractor_key']}-{data['id']}"
+
+
+def cache_key_for_url(url):
+    """Works out the cache key of a url without any network requests. Returns None for search queries or urls
+    where the video id can't be read from the url itself"""
+
+    if not re.match(r'^https?://', url):
+        return None
+
+    for extractor in extractors:
+        if extractor.suitable(url):
+            video_id = extractor.get_temp_id(url)
+            return f"{extractor.ie_key()}-{video_id}" if video_id else None
+    return None
+
+
+def warm_up_extractors():
+    """The first cache_key_for_url compiles the url pattern of every extractor, which takes a few hundred ms. Run
+    once at startup, off the event loop, so no command has to wait for it"""
 
+    cache_key_for_url("https://warm-up.invalid/")
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=0.5):
-        super().__init__(source, volume)
 
-        self.data = data
+def first_entry(data):
+    if 'entries' in data:
+        # take first item from a playlist
+        return data['entries'][0]
+    return data
 
-        self.title = data.get('title')
-        self.url = data.get('url')
+
+async def resolve_track(url, *, scheduler, guild_id, cache=None, metadata_cache=None):
+    """Resolves a url or search query into a Track without downloading it. Tracks already in the audio cache come
+    back with their filepath set. yt-dlp is only used when neither the audio cache nor the metadata cache know
+    the track"""
+
+    key = cache_key_for_url(url)
+    data = await cache.lookup(key) if key is not None and cache is not None else None
+    if data is not None:
+        return Track.from_info(key, data, cache.cached_filepath(key))
+
+    if metadata_cache is not None:
+        data = metadata_cache.get(url)
+        if data is None and key is not None:
+            data = metadata_cache.get_by_key(key)
+
+    if data is None:
+        data = await scheduler.submit(guild_id, ('extract', url), extract, url, False)
+        metrics.extract_seconds.observe(data['elapsed'])
+        if metadata_cache is not None:
+            metadata_cache.put(url, cache_key(data), {k: data.get(k) for k in cacheable_metadata})
+
+    key = cache_key(data)
+    filepath = cache.cached_filepath(key) if cache is not None else None
+    return Track.from_info(key, data, filepath)
+
+
+async def download_track(url, key, *, scheduler, guild_id, cache=None):
+    """Downloads a track into the audio cache and returns the path of the downloaded file"""
+
+    # Keyed by the cache key so different urls of the same video are only downloaded once
+    data = await scheduler.submit(guild_id, ('download', key), download, url, key, limited=False)
+
+    filename = data['filepath']
+    metrics.download_seconds.observe(data['elapsed'])
+    metrics.download_bytes.observe(data['filesize'])
+    if cache is not None:
+        metadata = {k: data.get(k) for k in cacheable_metadata}
+        cache.add(cache_key(data), filename, dict(metadata, loudness=data.get('loudness')), size=data['filesize'])
+    return filename
+
+
+async def stream_url(url, *, scheduler, guild_id):
+    """Extracts a fresh media url for streaming. Media urls expire, so these are never cached"""
+
+    data = await scheduler.submit(guild_id, ('stream', url), extract, url, False, limited=False)
+    metrics.extract_seconds.observe(data['elapsed'])
+    return data['url']
+
+
+async def playlist_tracks(url, *, scheduler, guild_id, cache=None, limit=max_playlist_size):
+    """Lists the tracks of a playlist a batch at a time, so the first songs can be queued while the rest are still
+    being listed. The tracks aren't resolved or downloaded"""
+
+    start = 1
+    while start <= limit:
+        end = min(start + playlist_batch_size - 1, limit)
+        entries, listed = await scheduler.submit(guild_id, ('playlist', url, start), extract_playlist_entries, url,
+                                                 start, end)
+
+        tracks = []
+        for entry in entries:
+            key = cache_key(entry)
+            tracks.append(Track.from_info(key, entry, cache.cached_filepath(key) if cache is not None else None))
+        if tracks:
+            yield tracks
+
+        # Unavailable entries are left out of entries, only a short listing means the playlist ended
+        if listed < end - start + 1:
+            return
+        start = end + 1
+
+
+def seek_options(options, position):
+    if not position:
+        return options
+    before_options = f"{options.get('before_options', '')} -ss {position:.2f}".strip()
+    return dict(options, before_options=before_options)
+
+
+def ffmpeg_volume(volume):
+    """Volume ffmpeg plays a PCM source at. A muted source is muted in the bot process, so it can be turned up"""
+
+    return volume if volume > 0 else 1
+
+
+def gain_options(options, gain):
+    if gain == 1:
+        return options
+    return dict(options, options=f"{options['options']} -af volume={gain:.3f}")
+
+
+class PlaybackPosition:
+    """Keeps track of how far into its track an audio source is, one read is one 20ms frame"""
+
+    def __init__(self, track, start_position):
+        self.track = track
+        self.title = track.title
+        self.key = track.key
+
+        self.start_position = start_position
+        self.frames = 0
+        self.ended = False
+        # perf_counter time of the play command that queued the track, recorded once its first frame is read
+        self.requested_at = None
+
+    def read(self):
+        data = super().read()
+        if data:
+            if self.frames == 0 and self.requested_at is not None:
+                metrics.play_to_audio_seconds.observe(time.perf_counter() - self.requested_at)
+            self.frames += 1
+        else:
+            self.ended = True
+        return data
+
+    @property
+    def elapsed(self):
+        """Position in the track in seconds"""
+
+        return self.start_position + self.frames * discord.opus.Encoder.FRAME_LENGTH / 1000
+
+
+class YTDLSource(PlaybackPosition, PCMTransformer):
+    """Plays a track through ffmpeg. ffmpeg applies the starting volume while decoding, so frames are only scaled
+    in the bot process while the volume is changed from there or the track fades"""
+
+    def __init__(self, source, *, track, volume=default_volume, streamed=False, start_position=0):
+        PCMTransformer.__init__(self, source, volume, applied=ffmpeg_volume(volume))
+        PlaybackPosition.__init__(self, track, start_position)
+
+        self.streamed = streamed
+
+    def stream_failed(self, error):
+        """A stream failed if it errored or ffmpeg gave up (e.g. the media url expired or it ran out of reconnect
+        attempts) well before the end of the track. Stopping the voice client or fading out doesn't count as ending"""
+
+        if not self.streamed or self.faded_out:
+            return False
+        if error is not None:
+            return True
+        duration = self.track.duration
+        return self.ended and duration is not None and self.elapsed < duration - stream_end_tolerance
 
     @classmethod
-    async def from_url(cls, url, *, loop=None, stream=False):
-        loop = loop or asyncio.get_event_loop()
-        data = await loop.run_in_executor(None, lambda: ytdl.extract_info(url, download=not stream))
+    def from_track(cls, track, *, position=0, volume=default_volume):
+        """Spawns the ffmpeg process for a track, only done once the track is about to play"""
 
-        if 'entries' in data:
-            # take first item from a playlist
-            data = data['entries'][0]
+        # The loudness gain and the volume are applied by ffmpeg, which is decoding the file anyway
+        options = gain_options(seek_options(ffmpeg_options, position),
+                               loudness_gain(track.loudness) * ffmpeg_volume(volume))
+        return cls(
+            discord.FFmpegPCMAudio(
+                track.filepath,
+                **options),
+            track=track,
+            volume=volume,
+            start_position=position
+        )
 
-        filename = data['url'] if stream else ytdl.prepare_filename(data)
+    @classmethod
+    def from_stream(cls, track, media_url, *, position=0, volume=default_volume):
         return cls(
             discord.FFmpegPCMAudio(
-                filename,
-                **ffmpeg_options),
-            data=data
+                media_url,
+                **gain_options(seek_options(stream_ffmpeg_options, position), ffmpeg_volume(volume))),
+            track=track,
+            volume=volume,
+            streamed=True,
+            start_position=position
         )
+
+
+class OpusSource(PlaybackPosition, discord.FFmpegOpusAudio):
+    """Plays a file from the opus cache. At the default volume the packets are passed straight through to discord.
+    Any other volume is applied by ffmpeg, so the bot process never encodes audio itself. The loudness gain was
+    applied when the file was encoded"""
+
+    def __init__(self, track, *, volume=default_volume, start_position=0):
+        gain = volume / default_volume
+        options = gain_options(seek_options(ffmpeg_options, start_position), gain)
+
+        discord.FFmpegOpusAudio.__init__(self, track.filepath, bitrate=opus_bitrate,
+                                         codec='copy' if gain == 1 else None, **options)
+        PlaybackPosition.__init__(self, track, start_position)
+
+        self.volume = volume
+        self.streamed = False
+
+    def stream_failed(self, error):
+        return False
+
+    def with_volume(self, volume):
+        """Opens the track again from the current position at a different volume"""
+
+        return OpusSource(self.track, volume=volume, start_position=self.elapsed)
+
+
+def create_source(track, *, position=0, volume=default_volume):
+    """Spawns the ffmpeg process for a downloaded track, only done once the track is about to play"""
+
+    if track.filepath.endswith('.opus'):
+        return OpusSource(track, volume=volume, start_position=position)
+    return YTDLSource.from_track(track, position=position, volume=volume)